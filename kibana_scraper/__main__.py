@@ -1,14 +1,23 @@
-
 from .main import scrape
 from optparse import OptionParser
 
-parser = OptionParser()
+parser = OptionParser(usage="%prog [options] [reprocess [section ...]]")
 parser.add_option("-u", "--username", dest="username", default=None,
                   help="Username to be used if login is required")
 parser.add_option("-p", "--password",dest="password", default=None,
                   help="Password to be used if login is required")
+parser.add_option("-m", "--model", dest="model", default="hp",
+                  help="Model of the reprocess command: hp or stl")
+parser.add_option("-w", "--workers", dest="workers", type="int", default=None,
+                  help="Number of processes of the reprocess command, all the cores by default")
 
 (options, args) = parser.parse_args()
 
 if __name__=="__main__":
-    scrape(options.username, options.password)
+    if len(args) > 0 and args[0] == "reprocess":
+        from .reprocess import reprocess
+        reprocess(args[1:], options.model, options.workers)
+    elif len(args) > 0:
+        parser.error("Unknown command: " + args[0])
+    else:
+        scrape(options.username, options.password)
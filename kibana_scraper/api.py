@@ -0,0 +1,312 @@
+"""
+kibana_scraper/api.py
+
+Implements the API based scraping functionality of the package
+
+Instead of driving the Discover page, the documents are requested directly
+from Elasticsearch through the Kibana console proxy, one page of hits at a time.
+
+Exports the ApiRobot class, which has the same public interface as the Robot:
+
+ApiRobot.go(target)
+"""
+import re
+import json
+from datetime import datetime, timezone
+from urllib.parse import urlparse, quote
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+import logging
+logger = logging.getLogger(__name__)
+
+from .config import config
+from .signals import signals
+from . import decoding
+
+LONG_WAIT = config["DEFAULT"].getint("long_wait", 60)
+
+# How long Elasticsearch keeps the point in time of a search between two pages
+PIT_KEEP_ALIVE = "10m"
+
+
+class LoginRequired(Exception):
+    """Raised when the Kibana API rejects the request for lack of a session"""
+
+
+def parse_time(value):
+    """Converts a from_time_utc / to_time_utc option value into a value accepted by a range query"""
+    value = value.strip().strip("'")
+    if value == "now":
+        return value
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc).isoformat(timespec="milliseconds")
+
+
+class SearchQuery:
+    """The search parameters encoded in a Discover URL template"""
+
+    def __init__(self, base_url, index_pattern, time_field, order="desc"):
+        self.base_url = base_url
+        self.index_pattern = index_pattern
+        self.time_field = time_field
+        self.order = order
+
+    @staticmethod
+    def from_url(url):
+        """Extracts the search parameters from a target url"""
+        parsed = urlparse(url)
+        base_url = f"{parsed.scheme}://{parsed.netloc}"
+
+        index = re.search(r"[(,]index:'?([^',)]+)'?", parsed.fragment)
+        if index is None:
+            raise ValueError("Index pattern is missing from the URL: " + url)
+
+        sort = re.search(r"sort:!\(!\('?([^',)]+)'?,(asc|desc)\)", parsed.fragment)
+        if sort is None:
+            raise ValueError("Sort order is missing from the URL: " + url)
+
+        return SearchQuery(base_url, index.group(1), sort.group(1), sort.group(2))
+
+
+class ApiRobot:
+    def __init__(self, username, password, worker=0):
+        self.username = username
+        self.password = password
+        self.worker = worker
+        self.cookies = {}
+        self.index_titles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    # HTTP helpers
+
+    def request(self, url, body=None, decode=json.loads):
+        """Sends a request to Kibana and returns the response, decoded with decode"""
+        headers = {"kbn-xsrf": "kibana_scraper"}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+            body = json.dumps(body).encode("utf-8")
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+
+        try:
+            with urlopen(Request(url, data=body, headers=headers), timeout=LONG_WAIT) as response:
+                return decode(response.read().decode("utf-8"))
+        except HTTPError as e:
+            if e.code in (401, 403):
+                raise LoginRequired(url) from e
+            raise
+
+    def login(self, url):
+        """Logs in with the browser and takes over its session cookies"""
+        # The browser is only needed to obtain the session, so it is imported lazily
+        from .robot import Robot
+
+        parsed = urlparse(url)
+        kibana_url = f"{parsed.scheme}://{parsed.netloc}/app/kibana"
+
+        logger.info("Login required, obtaining session cookies with the browser")
+        robot = Robot(self.username, self.password, self.worker)
+        try:
+            cookies = robot.login(kibana_url)
+        finally:
+            robot.driver.quit()
+
+        self.cookies = {cookie["name"]: cookie["value"] for cookie in cookies}
+
+    def call(self, url, body=None, decode=json.loads):
+        """Sends a request, logging in once if the session is missing or expired"""
+        try:
+            return self.request(url, body, decode)
+        except LoginRequired:
+            self.login(url)
+            return self.request(url, body, decode)
+
+    # Search
+
+    def get_index_title(self, query, target):
+        """Returns the index (pattern) to search, resolved from the index pattern id of the URL"""
+        index = target.config.get("index", None)
+        if index is not None:
+            return index
+
+        if query.index_pattern not in self.index_titles:
+            url = f"{query.base_url}/api/saved_objects/index-pattern/{quote(query.index_pattern)}"
+            response = self.call(url)
+            self.index_titles[query.index_pattern] = response["attributes"]["title"]
+
+        return self.index_titles[query.index_pattern]
+
+    def get_proxy_url(self, query, path, method="POST"):
+        return f"{query.base_url}/api/console/proxy?path={quote(path)}&method={method}"
+
+    def get_search_url(self, target, query, pit_id=None):
+        if pit_id is not None:
+            # The index is the one of the point in time
+            return self.get_proxy_url(query, "_search")
+        return self.get_proxy_url(query, self.get_index_title(query, target) + "/_search")
+
+    def get_tiebreaker(self, target):
+        """Returns the field breaking the ties between the hits of the same timestamp
+
+        _shard_doc (the default) needs a point in time (Elasticsearch 7.12 and later), other fields must be
+        keyword fields with doc values. _id can only be used up to Elasticsearch 7.5."""
+        return target.config.get("sort_tiebreaker", "_shard_doc")
+
+    def open_pit(self, target, query):
+        """Opens a point in time of the index, returns its id"""
+        index = self.get_index_title(query, target)
+        return self.call(self.get_proxy_url(query, f"{index}/_pit?keep_alive={PIT_KEEP_ALIVE}"), {})["id"]
+
+    def close_pit(self, query, pit_id):
+        try:
+            self.call(self.get_proxy_url(query, "_pit", "DELETE"), {"id": pit_id})
+        except Exception as e:
+            # It expires anyway
+            logger.warning("Failed to close the point in time: %s", e)
+
+    def build_search_body(self, target, query, search_after=None, pit_id=None):
+        page_size = target.config.getint("page_size", 500)
+        from_time = parse_time(target.from_time_utc)
+        to_time = parse_time(target.to_time_utc)
+
+        body = {
+            "size": page_size,
+            "query": {"bool": {"filter": [
+                {"range": {query.time_field: {"gte": from_time, "lte": to_time}}}
+            ]}},
+            # The tiebreaker orders the documents sharing a timestamp,
+            # so search_after never repeats or skips a hit
+            "sort": [{query.time_field: {"order": query.order}}, {self.get_tiebreaker(target): {"order": "asc"}}],
+            # Kibana shows the formatted time field under 'fields', the records rely on it
+            "docvalue_fields": [{"field": query.time_field, "format": "strict_date_time"}],
+        }
+        if search_after is not None:
+            body["search_after"] = search_after
+        if pit_id is not None:
+            body["pit"] = {"id": pit_id, "keep_alive": PIT_KEEP_ALIVE}
+
+        return body
+
+    def search(self, target, query, search_after=None, pit=None):
+        """Returns one page of hits. The id of the point in time (pit["id"]) is updated from the response"""
+        pit_id = None if pit is None else pit["id"]
+        url = self.get_search_url(target, query, pit_id)
+        body = self.build_search_body(target, query, search_after, pit_id)
+
+        # The signals of the hits are decoded into arrays right away, the hits are parsed without encoding them again
+        response = self.call(url, body, decoding.loads)
+        if pit is not None:
+            pit["id"] = response.get("pit_id", pit_id)
+        return response["hits"]["hits"]
+
+    def count_hits(self, target):
+        """Returns the number of hits in the time window of the target (or shard)"""
+        query = SearchQuery.from_url(target.config["url"])
+        url = self.get_search_url(target, query)
+
+        body = self.build_search_body(target, query)
+        body["size"] = 0
+        body["track_total_hits"] = True
+        # The tiebreaker may need a point in time
+        del body["sort"]
+
+        total = self.call(url, body)["hits"]["total"]
+        # Elasticsearch 6 returns a number, 7 returns an object
+        return total["value"] if isinstance(total, dict) else total
+
+    def pages(self, target, query, search_after=None, pit=None):
+        """Yields the pages of hits, until the search is exhausted"""
+        while True:
+            try:
+                hits = self.search(target, query, search_after, pit)
+            except HTTPError as e:
+                if pit is None or e.code != 404 or search_after is None:
+                    raise
+                logger.warning("The point in time expired, continuing with a new one")
+                pit["id"] = self.open_pit(target, query)
+                search_after = self.get_search_after({"search_after": search_after}, "_shard_doc")
+                hits = self.search(target, query, search_after, pit)
+            if len(hits) == 0:
+                return
+
+            yield hits
+            search_after = hits[-1]["sort"]
+
+    def get_search_after(self, cursor, tiebreaker):
+        """Returns the search_after of the page saved in the cursor, or None to start over"""
+        if cursor is None:
+            return None
+        search_after = cursor.get("search_after", None)
+        if search_after is None:
+            # e.g. the position of the browser engine
+            logger.info("The checkpoint has no search_after, starting over")
+            return None
+
+        if tiebreaker == "_shard_doc" or cursor.get("tiebreaker", None) != tiebreaker:
+            # The tiebreaker values of another search are not comparable, so the hits of the last timestamp are
+            # requested again, the ones already stored are skipped
+            return [search_after[0], -1 if tiebreaker == "_shard_doc" else ""]
+        return search_after
+
+    # Processing
+
+    def process_hits(self, target, hits):
+        documents = []
+        user_ids = []
+        for hit in hits:
+            user_id = hit["_id"]
+            if target.seen(user_id):
+                logger.info("Already in cache: %s", user_id)
+                continue
+
+            documents.append(hit)
+            user_ids.append(user_id)
+
+        if signals.stop:
+            return
+
+        target.process_batch(documents, user_ids)
+
+    def go(self, target):
+        """Process the search at: target.config.url"""
+        url = target.config.get("url", None)
+        if url is None:
+            raise ValueError("URL is not set for section: " + target.section)
+
+        query = SearchQuery.from_url(url)
+
+        tiebreaker = self.get_tiebreaker(target)
+        search_after = self.get_search_after(target.get_cursor(), tiebreaker)
+        if search_after is not None:
+            logger.info("Resuming after: %s", search_after)
+
+        pit = {"id": self.open_pit(target, query)} if tiebreaker == "_shard_doc" else None
+        try:
+            for hits in self.pages(target, query, search_after, pit):
+                if signals.stop:
+                    return
+
+                logger.info("Loaded %d documents", len(hits))
+                if not config["DEFAULT"].getboolean("fast_scan", False):
+                    self.process_hits(target, hits)
+
+                if signals.stop:
+                    return
+
+                # The page is fully processed, a restart can continue with the next one
+                target.save_cursor({"search_after": hits[-1]["sort"], "tiebreaker": tiebreaker})
+        finally:
+            if pit is not None:
+                self.close_pit(query, pit["id"])
+
+        logger.info("No more elements to parse")
+        target.complete()
+
+    def screenshot(self):
+        """There is no browser window to capture"""
+        pass
@@ -0,0 +1,322 @@
+"""
+kibana_scraper/archive.py
+
+Keeps the JSON documents of a section (with save_json_files) in an archive
+
+The documents are compressed, and appended to the segment files of
+cache/<section>/json, a new segment is started when the current one reaches
+json_archive_segment_size MB. The segment and the offset of every document is
+kept in an SQLite index (cache/<section>/json/index.sqlite), keyed by the
+User ID, for random access, and the documents can be read in the order of the
+segments for bulk processing.
+
+A record of a segment is the length of the User ID and of the compressed
+document, then the User ID and the document itself, so the index can be
+rebuilt from the segments. The segments are synced to the disk before the
+index is committed, and the documents appended after the last commit are
+indexed again when the archive is opened.
+
+An archive opened read-only (e.g. by the stub server, while a scraper may be
+appending to it) only sees the documents indexed so far, and doesn't change
+the segments or the index.
+
+The documents of the earlier versions, one file for each, are moved into the
+archive with the migrate command.
+
+Usage:
+    python -m kibana_scraper.archive [migrate|stats] [section ...]
+"""
+import os
+import re
+import pathlib
+import sys
+import zlib
+import struct
+import sqlite3
+import threading
+
+from .config import config
+
+import logging
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    user_id TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_position ON documents (segment, offset);
+"""
+
+# Length of the User ID and of the compressed document
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_PATTERN = re.compile(r"^segment-(\d+)\.jsz$")
+
+# Number of documents read from the index at once by the iterator
+PAGE_SIZE = 1000
+
+# The archives of the sections, shared by all their targets
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+class JsonArchive:
+    def __init__(self, folder, segment_size=256, level=1, sync_documents=500, readonly=False):
+        self.folder = folder
+        self.readonly = readonly
+        self.segment_size = segment_size * 1024 * 1024
+        self.level = level
+        self.sync_documents = sync_documents
+        self.lock = threading.RLock()
+        self.output = None
+        self.output_segment = None
+        self.unsynced = 0
+
+        path = os.path.join(folder, "index.sqlite")
+        if readonly:
+            # Without the recovery, which could truncate the segment being written by another process
+            uri = pathlib.Path(path).absolute().as_uri() + "?mode=ro"
+            self.connection = sqlite3.connect(uri, uri=True, timeout=60, check_same_thread=False)
+            return
+
+        os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.recover()
+
+    @staticmethod
+    def get(section):
+        """Returns the archive of a section, shared by all its targets"""
+        with _archives_lock:
+            if section not in _archives:
+                settings = config["DEFAULT"]
+                _archives[section] = JsonArchive(os.path.join("cache", section, "json"),
+                                                 settings.getint("json_archive_segment_size", 256),
+                                                 settings.getint("json_archive_compression_level", 1),
+                                                 settings.getint("store_sync_rows", 500))
+            return _archives[section]
+
+    def get_segment_path(self, segment):
+        return os.path.join(self.folder, f"segment-{segment:05}.jsz")
+
+    def get_segments(self):
+        """Returns the numbers of the segment files, in order"""
+        return sorted(int(match.group(1)) for match in map(SEGMENT_PATTERN.match, os.listdir(self.folder))
+                      if match is not None)
+
+    def recover(self):
+        """Indexes the documents appended after the last commit, and drops a partially written one"""
+        ends = dict(self.connection.execute("SELECT segment, MAX(offset + length) FROM documents GROUP BY segment"))
+        recovered = 0
+        for segment in self.get_segments():
+            path = self.get_segment_path(segment)
+            start = ends.get(segment, 0)
+            if os.path.getsize(path) <= start:
+                continue
+
+            end = start
+            with open(path, "rb") as f:
+                f.seek(start)
+                for user_id, offset, length, data in read_records(f):
+                    self.connection.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                                            (user_id, segment, offset, length, len(zlib.decompress(data))))
+                    end = offset + length
+                    recovered += 1
+            if end < os.path.getsize(path):
+                logger.warning("Dropping a partially written document from %s", path)
+                with open(path, "rb+") as f:
+                    f.truncate(end)
+        self.connection.commit()
+
+        if recovered > 0:
+            logger.info("%d documents indexed again in %s", recovered, self.folder)
+
+    def open_output(self):
+        segments = self.get_segments()
+        segment = segments[-1] if len(segments) > 0 else 0
+        if len(segments) > 0 and os.path.getsize(self.get_segment_path(segment)) >= self.segment_size:
+            segment += 1
+        self.output = open(self.get_segment_path(segment), "ab")
+        self.output_segment = segment
+
+    def append(self, user_id, text):
+        """Adds a document, or replaces the one of the same User ID"""
+        if self.readonly:
+            raise RuntimeError(f"The archive {self.folder} is open read-only")
+        data = text.encode("utf-8")
+        compressed = zlib.compress(data, self.level)
+        key = user_id.encode("utf-8")
+        record = RECORD_HEADER.pack(len(key), len(compressed)) + key + compressed
+
+        with self.lock:
+            if self.output is None or self.output.tell() >= self.segment_size:
+                if self.output is not None:
+                    self.sync()
+                    self.output.close()
+                self.open_output()
+
+            offset = self.output.tell()
+            self.output.write(record)
+            self.connection.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                                    (user_id, self.output_segment, offset, len(record), len(data)))
+            self.unsynced += 1
+            if self.unsynced >= self.sync_documents > 0:
+                self.sync()
+
+    def sync(self):
+        """Makes the appended documents durable, the segment first, then the index"""
+        with self.lock:
+            if self.output is not None:
+                self.output.flush()
+                os.fsync(self.output.fileno())
+            self.connection.commit()
+            self.unsynced = 0
+
+    def read(self, segment, offset, length):
+        with self.lock:
+            if segment == self.output_segment:
+                self.output.flush()
+        with open(self.get_segment_path(segment), "rb") as f:
+            f.seek(offset)
+            return decode_record(f.read(length))[1]
+
+    def load(self, user_id):
+        """Returns the document of a User ID, or None"""
+        with self.lock:
+            position = self.connection.execute("SELECT segment, offset, length FROM documents WHERE user_id = ?",
+                                               (user_id,)).fetchone()
+        return None if position is None else self.read(*position)
+
+    def __contains__(self, user_id):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM documents WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def __iter__(self):
+        """Yields the User ID and the document of every document, in the order of the segments"""
+        with self.lock:
+            if self.output is not None:
+                self.output.flush()
+
+        last = (-1, -1)
+        f, f_segment = None, None
+        try:
+            while True:
+                with self.lock:
+                    page = self.connection.execute(
+                        "SELECT user_id, segment, offset, length FROM documents WHERE (segment, offset) > (?, ?) "
+                        "ORDER BY segment, offset LIMIT ?", last + (PAGE_SIZE,)).fetchall()
+                if len(page) == 0:
+                    return
+
+                for user_id, segment, offset, length in page:
+                    if segment != f_segment:
+                        if f is not None:
+                            f.close()
+                        f, f_segment = open(self.get_segment_path(segment), "rb"), segment
+                    # The replaced documents are skipped
+                    if f.tell() != offset:
+                        f.seek(offset)
+                    yield user_id, decode_record(f.read(length))[1]
+                last = page[-1][1], page[-1][2]
+        finally:
+            if f is not None:
+                f.close()
+
+    def stats(self):
+        with self.lock:
+            documents, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents").fetchone()
+        segments = self.get_segments()
+        disk = sum(os.path.getsize(self.get_segment_path(segment)) for segment in segments)
+        return {"documents": documents, "segments": len(segments), "MB on disk": round(disk / 1e6, 1),
+                "MB decompressed": round(size / 1e6, 1)}
+
+    def close(self):
+        with self.lock:
+            if not self.readonly:
+                self.sync()
+            if self.output is not None:
+                self.output.close()
+                self.output = None
+                self.output_segment = None
+            self.connection.close()
+
+
+def decode_record(record):
+    """Returns the User ID and the document of a record"""
+    key_length, data_length = RECORD_HEADER.unpack_from(record)
+    start = RECORD_HEADER.size
+    user_id = record[start:start + key_length].decode("utf-8")
+    return user_id, zlib.decompress(record[start + key_length:start + key_length + data_length]).decode("utf-8")
+
+
+def read_records(f):
+    """Yields the User ID, offset, length and compressed document of the complete records from the position of f"""
+    while True:
+        offset = f.tell()
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        key_length, data_length = RECORD_HEADER.unpack(header)
+        key = f.read(key_length)
+        data = f.read(data_length)
+        if len(key) < key_length or len(data) < data_length:
+            return
+        yield key.decode("utf-8"), offset, RECORD_HEADER.size + key_length + data_length, data
+
+
+def shutdown():
+    """Closes the archives opened by this run"""
+    with _archives_lock:
+        archives = list(_archives.values())
+        _archives.clear()
+    for archive in archives:
+        archive.close()
+
+
+def migrate(section, keep=False):
+    """Moves the documents of the per-file layout into the archive, returns the number of documents moved
+
+    The files are removed after their documents were synced, so an interrupted migration can be run again."""
+    archive = JsonArchive.get(section)
+    filenames = sorted(filename for filename in os.listdir(archive.folder) if filename.endswith(".json"))
+    logger.info("%s: %d documents to migrate", section, len(filenames))
+
+    done = []
+    for i, filename in enumerate(filenames):
+        path = os.path.join(archive.folder, filename)
+        with open(path, "rt") as f:
+            archive.append(filename[:-len(".json")], f.read())
+        done.append(path)
+
+        if len(done) >= 1000 or i == len(filenames) - 1:
+            archive.sync()
+            if not keep:
+                for done_path in done:
+                    os.remove(done_path)
+            done = []
+            logger.info("%s: %d of %d documents migrated", section, i + 1, len(filenames))
+    return len(filenames)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    sections = sys.argv[2:] or [section for section in config.sections()
+                                if os.path.isdir(os.path.join("cache", section, "json"))]
+    if command == "migrate":
+        for section in sections:
+            migrate(section)
+    elif command == "stats":
+        for section in sections:
+            print(section + ":", ", ".join(f"{value} {name}" for name, value in JsonArchive.get(section).stats().items()))
+    else:
+        print(__doc__)
+    shutdown()
@@ -0,0 +1,475 @@
+"""
+kibana_scraper/benchmarks.py
+
+Benchmarks of the processing steps, on synthetic documents
+
+Usage:
+    python -m kibana_scraper.benchmarks [name ...]
+
+Without names, all the benchmarks are run.
+"""
+import io
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from . import decoding
+from .records import RecordFactory
+import heartpy as hp
+import pandas as pd
+from scipy.signal import resample
+from .models import BaseModel, HPModel, PeriodSearch
+from .preprocessing import Preprocessor
+from .seen import SeenIndex
+from .store import SegmentStore
+from .export import export_sections, pa
+from .config import config
+from .archive import JsonArchive
+from .stub_server import generate_documents
+
+
+def measure_time(function, repeat):
+    """Returns the average run time of the function in seconds"""
+    start = time.perf_counter()
+    for i in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def measure_peak_memory(function):
+    """Returns the peak of the memory allocated by the function in bytes"""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_decoding():
+    """json.loads, then the signals converted to arrays, vs. the decoders of the decoding module"""
+    decoders = [("json", None), ("buffered", decoding.loads_buffered)]
+    if decoding.orjson is not None:
+        decoders.append(("orjson", decoding.loads))
+
+    print("Decoding: json.loads + np.asarray vs. " + ", ".join(name for name, decoder in decoders[1:]))
+    print(f"{'samples':>10} {'size MB':>8} " + " ".join(f"{name + ' ms':>12} {name + ' MB/s':>14} {name + ' peak MB':>16}"
+                                                    for name, decoder in decoders))
+
+    for samples in (1000, 10000, 100000):
+        text = json.dumps(generate_documents(1, samples=samples)[0])
+        size = len(text) / 1e6
+
+        def with_json():
+            data = json.loads(text)
+            channel = data["_source"]["channels"][0]
+            return np.asarray(channel["time"], dtype=np.float64), np.asarray(channel["amplitude"], dtype=np.float64)
+
+        line = f"{samples:>10} {size:>8.2f} "
+        repeat = max(3, 300000 // samples)
+        for name, decoder in decoders:
+            function = with_json if decoder is None else (lambda: decoder(text))
+            run_time = measure_time(function, repeat)
+            peak = measure_peak_memory(function) / 1e6
+            line += f"{run_time * 1000:>12.2f} {size / run_time:>14.1f} {peak:>16.2f} "
+
+        print(line)
+
+
+def benchmark_records():
+    """Records built and written one at a time vs. load_batch, without the measures"""
+    print("Records: RecordFactory.loads one by one vs. RecordFactory.load_batch, written as CSV")
+    print(f"{'documents':>10} {'one by one ms':>14} {'batch ms':>10} {'records/s':>12} {'batch records/s':>16}")
+
+    for count in (50, 100, 500):
+        documents = [json.dumps(document) for document in generate_documents(count, samples=200)]
+
+        def one_by_one():
+            writer = csv.writer(io.StringIO())
+            for document in documents:
+                record = RecordFactory.loads(HPModel, document)
+                writer.writerow([record[key] for key in record.keys() if key in record.positions])
+
+        def batch():
+            writer = csv.writer(io.StringIO())
+            writer.writerows(RecordFactory.load_batch(HPModel, documents).rows())
+
+        single_time = measure_time(one_by_one, 5)
+        batch_time = measure_time(batch, 5)
+        print(f"{count:>10} {single_time * 1000:>14.2f} {batch_time * 1000:>10.2f} "
+              f"{count / single_time:>12.0f} {count / batch_time:>16.0f}")
+
+
+def dataframe_model(time, amplitude):
+    """The model set up of the earlier versions, which built a DataFrame for every record"""
+    time = pd.to_timedelta(time, unit='seconds')
+    df = pd.DataFrame(list(zip(time, amplitude)))
+    df.columns = ["time", "amplitude"]
+    df.set_index("time", inplace=True)
+    return hp.get_samplerate_mstimer(time.total_seconds() * 1000), df.amplitude.to_numpy()
+
+
+def array_model(time, amplitude):
+    model = BaseModel(time, amplitude)
+    return model.get_sample_rate(), model.amplitude
+
+
+def benchmark_models():
+    """Per record overhead of the models, before the measures: the sample rate and the amplitude array"""
+    print("Models: DataFrame per record vs. arrays, from decoded documents")
+    print(f"{'samples':>10} {'DataFrame ms':>13} {'arrays ms':>10} {'speedup':>8} {'DataFrame peak MB':>18} {'arrays peak MB':>15}")
+
+    for samples in (1000, 10000, 100000):
+        data = decoding.loads(json.dumps(generate_documents(1, samples=samples)[0]))
+        channel = data["_source"]["channels"][0]
+        time, amplitude = channel["time"], channel["amplitude"]
+
+        repeat = max(3, 300000 // samples)
+        before = measure_time(lambda: dataframe_model(time, amplitude), repeat)
+        after = measure_time(lambda: array_model(time, amplitude), repeat)
+        before_peak = measure_peak_memory(lambda: dataframe_model(time, amplitude)) / 1e6
+        after_peak = measure_peak_memory(lambda: array_model(time, amplitude)) / 1e6
+        print(f"{samples:>10} {before * 1000:>13.3f} {after * 1000:>10.3f} {before / after:>8.0f} "
+              f"{before_peak:>18.2f} {after_peak:>15.2f}")
+
+
+def generate_ppg(random, seconds=30, sample_rate=100):
+    """Returns a synthetic PPG signal, with a random heart rate, baseline wander and noise"""
+    time = np.arange(seconds * sample_rate) / sample_rate
+    phase = (time * random.uniform(55, 100) / 60) % 1
+    pulse = np.exp(-((phase - 0.2) / 0.07) ** 2) + 0.4 * np.exp(-((phase - 0.55) / 0.1) ** 2)
+    wander = 0.3 * np.sin(2 * np.pi * random.uniform(0.1, 0.3) * time)
+    noise = random.normal(0, random.uniform(0.02, 0.3), len(time))
+    return 500 + 100 * (pulse + wander + noise)
+
+
+def benchmark_periods(records=10, workers=None):
+    """The STL period search methods vs. the exhaustive search, on a corpus of synthetic signals"""
+    random = np.random.default_rng(0)
+    corpus = [generate_ppg(random) for i in range(records)]
+    workers = workers or os.cpu_count()
+
+    methods = [("exhaustive", "exhaustive", None), ("coarse", "coarse", None), ("golden", "golden", None)]
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers)
+        methods += [(f"exhaustive x{workers}", "exhaustive", executor), (f"coarse x{workers}", "coarse", executor)]
+
+    print(f"STL period search, {records} records of 30 s at 100 Hz")
+    print(f"{'method':>16} {'s/record':>10} {'speedup':>8} {'fits/record':>12} {'same period':>12}")
+
+    reference = None
+    for name, method, executor in methods:
+        periods = []
+        fits = 0
+        start = time.perf_counter()
+        for amplitude in corpus:
+            search = PeriodSearch(amplitude, 100.0, executor=executor)
+            try:
+                periods.append(search.run(method))
+            except ValueError:
+                periods.append(None)
+            fits += len(search.results)
+        run_time = (time.perf_counter() - start) / records
+
+        reference = reference or (run_time, periods)
+        same = sum(period == expected for period, expected in zip(periods, reference[1]))
+        print(f"{name:>16} {run_time:>10.2f} {reference[0] / run_time:>8.1f} {fits / records:>12.1f} "
+              f"{same:>6} of {records}")
+
+
+def hp_preprocessing(signal, sample_rate):
+    """The preprocessing of HPModel in the earlier versions, for reference"""
+    data = hp.filter_signal(signal, [0.6, 3.6], sample_rate, order=3, filtertype='bandpass')
+    data = hp.smooth_signal(data, sample_rate, window_length=15)
+    return resample(data, len(data) * 1), sample_rate
+
+
+def benchmark_preprocessing(records=200):
+    """hp.filter_signal, smooth_signal and resample vs. the Preprocessor, one by one and in a batch"""
+    random = np.random.default_rng(0)
+    corpus = [generate_ppg(random) for i in range(records)]
+    sample_rate = 100.0
+    preprocessor = Preprocessor()
+
+    def reference():
+        return [hp_preprocessing(signal, sample_rate) for signal in corpus]
+
+    def one_by_one():
+        return [preprocessor.apply(signal, sample_rate) for signal in corpus]
+
+    def batch():
+        return preprocessor.apply_batch(corpus, [sample_rate] * records)
+
+    expected = reference()
+    print(f"Preprocessing, {records} records of 30 s at 100 Hz")
+    print(f"{'method':>12} {'ms/record':>10} {'speedup':>8} {'max difference':>15}")
+    reference_time = None
+    for name, function in (("reference", reference), ("one by one", one_by_one), ("batch", batch)):
+        run_time = measure_time(function, 3) / records
+        reference_time = reference_time or run_time
+        difference = max(np.max(np.abs(result[0] - signal[0])) for result, signal in zip(function(), expected))
+        print(f"{name:>12} {run_time * 1000:>10.3f} {reference_time / run_time:>8.1f} {difference:>15.2e}")
+
+
+def benchmark_seen(count=1000000, files=10):
+    """The boolean mask of the earlier versions vs. the SeenIndex, on count IDs in CSV files"""
+    random = np.random.default_rng(0)
+    ids = np.array([f"{value:020x}" for value in random.integers(0, 2 ** 63, count)])
+    folder = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(folder)
+        csv_cache = os.path.join("cache", "benchmark", "csv")
+        os.makedirs(csv_cache)
+        for i, part in enumerate(np.array_split(ids, files)):
+            pd.DataFrame({"User ID": part, "Timestamp": "2020-01-01T00:00:00.000Z",
+                          "bpm": random.uniform(50, 100, len(part))}).to_csv(
+                os.path.join(csv_cache, f"benchmark-{i}.csv"), index=False)
+
+        def load_record_cache():
+            return pd.concat([pd.read_csv(os.path.join(csv_cache, filename)) for filename in os.listdir(csv_cache)])
+
+        start = time.perf_counter()
+        record_cache = load_record_cache()
+        dataframe_load = time.perf_counter() - start
+        start = time.perf_counter()
+        index = SeenIndex(SegmentStore("benchmark"))
+        cold_load = time.perf_counter() - start
+        warm_load = measure_time(lambda: SeenIndex(SegmentStore("benchmark")), 3)
+        index_peak = measure_peak_memory(lambda: SeenIndex(SegmentStore("benchmark"))) / 1e6
+
+        # Half of the lookups are hits
+        lookups = np.concatenate([random.choice(ids, 50), [f"{value:020x}" for value in random.integers(0, 2 ** 63, 50)]])
+        mask_time = measure_time(lambda: [record_cache[record_cache["User ID"] == user_id].shape[0] > 0
+                                          for user_id in lookups], 1) / len(lookups)
+        lookups = lookups.tolist() * 1000
+        set_time = measure_time(lambda: [user_id in index for user_id in lookups], 3) / len(lookups)
+
+        print(f"Seen IDs: DataFrame mask vs. SeenIndex, {count} IDs in {files} CSV files")
+        print(f"{'':>22} {'DataFrame':>12} {'SeenIndex':>12} {'speedup':>10}")
+        print(f"{'lookup us':>22} {mask_time * 1e6:>12.1f} {set_time * 1e6:>12.3f} {mask_time / set_time:>10.0f}")
+        print(f"{'cold start s':>22} {dataframe_load:>12.2f} {cold_load:>12.2f} {dataframe_load / cold_load:>10.1f}")
+        print(f"{'persisted start s':>22} {dataframe_load:>12.2f} {warm_load:>12.2f} {dataframe_load / warm_load:>10.1f}")
+        print(f"{'index peak MB':>22} {'':>12} {index_peak:>12.1f}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+
+
+def write_runs(csv_cache, random, runs, rows):
+    """Writes the CSV files of runs scraping rows records each"""
+    for run in range(runs):
+        table = pd.DataFrame({"User ID": [f"{value:020x}" for value in random.integers(0, 2 ** 63, rows)],
+                              "Timestamp": pd.to_datetime(random.integers(1.5e9, 1.6e9, rows), unit="s").strftime(
+                                  "%Y-%m-%dT%H:%M:%S.000Z")})
+        table["Sex"] = random.choice(["M", "F", ""], rows)
+        table["Status"] = random.choice(["ok", "error"], rows)
+        table["DeviceMake"] = random.choice(["Apple", "Samsung", "Google", "Huawei"], rows)
+        for name in ("bpm", "ibi", "sdnn", "sdsd", "rmssd", "pnn20", "pnn50", "hr_mad", "sd1", "sd2", "s", "lf", "hf"):
+            table[name] = random.uniform(0, 100, rows)
+        table.to_csv(os.path.join(csv_cache, f"benchmark-{run:05}.csv"), index=False)
+
+
+def benchmark_store(rows=500):
+    """Start-up with the CSV files of many runs: all of them read, as in the earlier versions, vs. the SegmentStore"""
+    print(f"Store: start-up with the CSV files of many runs, {rows} records each")
+    print(f"{'runs':>6} {'read_csv s':>11} {'first open s':>13} {'reopen s':>9} {'segments':>9} "
+          f"{'compacted reopen s':>19} {'lookup ms':>10} {'day scan ms':>12}")
+
+    random = np.random.default_rng(0)
+    for runs in (10, 50, 200):
+        folder = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(folder)
+            csv_cache = os.path.join("cache", "benchmark", "csv")
+            os.makedirs(csv_cache)
+            write_runs(csv_cache, random, runs, rows)
+
+            read_time = measure_time(lambda: pd.concat([pd.read_csv(os.path.join(csv_cache, filename))
+                                                        for filename in os.listdir(csv_cache)]), 1)
+            first_time = measure_time(lambda: SegmentStore("benchmark"), 1)
+            reopen_time = measure_time(lambda: SegmentStore("benchmark"), 3)
+            store = SegmentStore("benchmark")
+            store.compact()
+            compacted_time = measure_time(lambda: SegmentStore("benchmark"), 3)
+
+            user_id = store.get_ids(sorted(store.segments)[0])[0]
+            lookup_time = measure_time(lambda: store.lookup(user_id), 3)
+            scan_time = measure_time(lambda: list(store.scan("2018-01-01", "2018-01-02")), 3)
+            print(f"{runs:>6} {read_time:>11.2f} {first_time:>13.2f} {reopen_time:>9.3f} {len(store.segments):>9} "
+                  f"{compacted_time:>19.3f} {lookup_time * 1000:>10.1f} {scan_time * 1000:>12.1f}")
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(folder)
+
+
+def pandas_export(sections, file_path):
+    """The export of the earlier versions, with every record in memory"""
+    tables = []
+    for section in sections:
+        csv_cache = os.path.join("cache", section, "csv")
+        table = pd.concat([pd.read_csv(os.path.join(csv_cache, filename)) for filename in os.listdir(csv_cache)])
+        tables.append(table.assign(**{"_index(Search type)": section}))
+    table = pd.concat(tables)
+    table.sort_values(["Timestamp"], inplace=True)
+    table.to_csv(file_path, index=False)
+
+
+def benchmark_export(sections=3, runs=10, rows=5000):
+    """pd.concat and sort_values of every record vs. the merge of the sorted segments"""
+    methods = (("pandas", pandas_export), ("merge, first", export_sections), ("merge, sorted", export_sections))
+    results = {}
+    # Timed and traced on separate copies of the data, as tracemalloc slows down the merge
+    for measure in ("time", "peak"):
+        random = np.random.default_rng(0)
+        folder = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(folder)
+            names = [f"benchmark{i}" for i in range(sections)]
+            for name in names:
+                csv_cache = os.path.join("cache", name, "csv")
+                os.makedirs(csv_cache)
+                write_runs(csv_cache, random, runs, rows)
+
+            for method, function in methods:
+                if measure == "time":
+                    results[method] = [measure_time(lambda: function(names, "export.csv"), 1)]
+                else:
+                    results[method].append(measure_peak_memory(lambda: function(names, "export.csv")) / 1e6)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(folder)
+
+    print(f"Export: {sections} sections of {runs} runs, {rows} records each")
+    print(f"{'method':>14} {'s':>7} {'peak MB':>8}")
+    for method, (run_time, peak) in results.items():
+        print(f"{method:>14} {run_time:>7.2f} {peak:>8.1f}")
+
+
+def benchmark_formats(runs=20, rows=5000, row_group_size=10000):
+    """Size and load time of the exported CSV vs. the Parquet and Feather files"""
+    if pa is None:
+        print("Formats: skipped, pyarrow is not installed")
+        return
+
+    config["DEFAULT"]["export_row_group_size"] = str(row_group_size)
+    readers = {
+        "csv": lambda path, day: pd.read_csv(path, parse_dates=["Timestamp"]),
+        "parquet": lambda path, day: pd.read_parquet(path, filters=day),
+        "feather": lambda path, day: pd.read_feather(path),
+    }
+    start, end = pd.Timestamp("2018-01-01", tz="UTC"), pd.Timestamp("2018-01-02", tz="UTC")
+    day = [("Timestamp", ">=", start), ("Timestamp", "<", end)]
+
+    def read_day(name, path):
+        if name == "parquet":
+            return readers[name](path, day)
+        # The CSV and Feather files are read whole, and filtered in memory
+        table = readers[name](path, None)
+        return table[(table["Timestamp"] >= start) & (table["Timestamp"] < end)]
+
+    print(f"Formats: export of {runs * rows} records, row groups of {row_group_size}, "
+          f"compression {config['DEFAULT'].get('export_compression', 'zstd')}")
+    print(f"{'format':>8} {'export s':>9} {'size MB':>8} {'load s':>7} {'one day s':>10}")
+    random = np.random.default_rng(0)
+    folder = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(folder)
+        csv_cache = os.path.join("cache", "benchmark", "csv")
+        os.makedirs(csv_cache)
+        write_runs(csv_cache, random, runs, rows)
+        # Sorted once, before the timed exports
+        export_sections(["benchmark"], "sorted.csv")
+
+        for name, read in readers.items():
+            path = "export." + name
+            export_time = measure_time(lambda: export_sections(["benchmark"], path), 1)
+            load_time = measure_time(lambda: read(path, None), 3)
+            day_time = measure_time(lambda: read_day(name, path), 3)
+            print(f"{name:>8} {export_time:>9.2f} {os.path.getsize(path) / 1e6:>8.1f} {load_time:>7.3f} {day_time:>10.3f}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+
+
+def disk_usage(folder):
+    """Returns the number of files and the disk space they take in MB"""
+    paths = [os.path.join(folder, filename) for filename in os.listdir(folder)]
+    return len(paths), sum(os.stat(path).st_blocks * 512 for path in paths) / 1e6
+
+
+def benchmark_archive(count=2000, samples=3000):
+    """One file for each document, as in the earlier versions, vs. the JsonArchive"""
+    documents = [(document["_id"], json.dumps(document)) for document in generate_documents(count, samples=samples)]
+    random = np.random.default_rng(0)
+    lookups = [documents[i][0] for i in random.integers(0, count, 200)]
+    folder = tempfile.mkdtemp()
+    try:
+        files_folder = os.path.join(folder, "files")
+        os.makedirs(files_folder)
+
+        def write_files():
+            for user_id, text in documents:
+                with open(os.path.join(files_folder, user_id + ".json"), "wt", newline="") as f:
+                    f.write(text)
+
+        def read_file(user_id):
+            with open(os.path.join(files_folder, user_id + ".json"), "rt") as f:
+                return f.read()
+
+        def scan_files():
+            for filename in sorted(os.listdir(files_folder)):
+                with open(os.path.join(files_folder, filename), "rt") as f:
+                    f.read()
+
+        archive = JsonArchive(os.path.join(folder, "archive"))
+
+        def write_archive():
+            for user_id, text in documents:
+                archive.append(user_id, text)
+            archive.sync()
+
+        print(f"Archive: {count} documents of {samples} samples, one file for each vs. JsonArchive")
+        print(f"{'layout':>8} {'write s':>8} {'files':>6} {'disk MB':>8} {'lookup ms':>10} {'scan s':>7}")
+        for name, write, read, scan, path in (
+                ("files", write_files, read_file, scan_files, files_folder),
+                ("archive", write_archive, archive.load, lambda: list(archive), archive.folder)):
+            write_time = measure_time(write, 1)
+            files, size = disk_usage(path)
+            lookup_time = measure_time(lambda: [read(user_id) for user_id in lookups], 3) / len(lookups)
+            scan_time = measure_time(scan, 1)
+            print(f"{name:>8} {write_time:>8.2f} {files:>6} {size:>8.1f} {lookup_time * 1000:>10.3f} {scan_time:>7.2f}")
+        archive.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+BENCHMARKS = {
+    "decoding": benchmark_decoding,
+    "records": benchmark_records,
+    "periods": benchmark_periods,
+    "models": benchmark_models,
+    "preprocessing": benchmark_preprocessing,
+    "seen": benchmark_seen,
+    "store": benchmark_store,
+    "export": benchmark_export,
+    "formats": benchmark_formats,
+    "archive": benchmark_archive,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
+        print()
@@ -0,0 +1,108 @@
+"""
+kibana_scraper/checkpoints.py
+
+Keeps the pagination state of the sections between runs
+
+The checkpoint of a section is stored in cache/<section>/checkpoint.json, and
+holds the cursor of the last fully processed page, and the shard plan with the
+state of each shard. It is rewritten atomically after every page, so an
+interrupted run can be resumed from the last page.
+"""
+import os
+import json
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The shards of a section share one checkpoint, possibly from several workers
+_checkpoints = {}
+_checkpoints_lock = threading.Lock()
+
+
+class Checkpoint:
+    def __init__(self, section):
+        self.section = section
+        self.path = os.path.join("cache", section, "checkpoint.json")
+        self.lock = threading.RLock()
+        self.state = self.load()
+
+    @staticmethod
+    def get(section):
+        """Returns the checkpoint of a section, shared by all its targets"""
+        with _checkpoints_lock:
+            if section not in _checkpoints:
+                _checkpoints[section] = Checkpoint(section)
+            return _checkpoints[section]
+
+    def load(self):
+        try:
+            with open(self.path, "rt") as f:
+                state = json.load(f)
+            logger.info("Resuming %s from checkpoint", self.section)
+            return state
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Ignoring corrupt checkpoint: %s", self.path)
+            return {}
+
+    def save(self):
+        """Writes the state into a temporary file, then replaces the checkpoint with it"""
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wt") as f:
+                json.dump(self.state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+
+    def clear(self):
+        """Removes the checkpoint, once the section is completed"""
+        with self.lock:
+            self.state = {}
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    # Cursors
+
+    def get_cursor(self, shard=None):
+        with self.lock:
+            if shard is None:
+                return self.state.get("cursor", None)
+            return self.state.get("shard_cursors", {}).get(shard, None)
+
+    def set_cursor(self, cursor, shard=None):
+        with self.lock:
+            if shard is None:
+                self.state["cursor"] = cursor
+            else:
+                self.state.setdefault("shard_cursors", {})[shard] = cursor
+            self.save()
+
+    # Shards
+
+    def get_plan(self):
+        """Returns the shard windows as (from_time_utc, to_time_utc) pairs, or None"""
+        with self.lock:
+            return self.state.get("plan", None)
+
+    def set_plan(self, plan):
+        with self.lock:
+            self.state["plan"] = plan
+            self.state["completed_shards"] = []
+            self.state["shard_cursors"] = {}
+            self.save()
+
+    def is_shard_completed(self, shard):
+        with self.lock:
+            return shard in self.state.get("completed_shards", [])
+
+    def complete_shard(self, shard):
+        with self.lock:
+            self.state.setdefault("completed_shards", []).append(shard)
+            self.state.get("shard_cursors", {}).pop(shard, None)
+            self.save()
@@ -0,0 +1,76 @@
+"""
+kibana_scraper/cursors.py
+
+Cursor of the page by page processing of the Discover results
+
+The Discover URL can only narrow the time range, and its upper bound is
+inclusive, so the next page starts at the timestamp of the last displayed row.
+To neither repeat nor skip the documents sharing that timestamp, the cursor
+also keeps their ids, and excludes them from the next page with the query.
+At most MAX_BOUNDARY_IDS ids are excluded, the most recent ones, the others
+are shown again, and skipped as already in the cache.
+"""
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The number of ids the query excludes at most, so the URL stays within the limits of the browser and Kibana
+MAX_BOUNDARY_IDS = 500
+
+# query:(language:kuery,query:'...') in the _a state of the URL, the query is rison encoded
+QUERY_PATTERN = re.compile(r"query:\(language:(kuery|lucene),query:'((?:[^'!]|!.)*)'\)")
+
+
+def rison_escape(text):
+    return text.replace("!", "!!").replace("'", "!'")
+
+
+class Cursor:
+    def __init__(self, to_time_utc, boundary_ids=None):
+        self.to_time_utc = to_time_utc
+        # In the order they were read, without duplicates
+        self.boundary_ids = list(dict.fromkeys(boundary_ids or []))
+
+    @staticmethod
+    def from_dict(data):
+        return Cursor(data["to_time_utc"], data.get("boundary_ids", []))
+
+    def to_dict(self):
+        return {"to_time_utc": self.to_time_utc, "boundary_ids": self.boundary_ids}
+
+    def advance(self, to_time_utc, tail_ids):
+        """Returns the cursor after a page, ending with the tail_ids documents at to_time_utc"""
+        if to_time_utc == self.to_time_utc:
+            # The documents of this timestamp span several pages
+            tail_ids = self.boundary_ids + list(tail_ids)
+        cursor = Cursor(to_time_utc, tail_ids)
+        if len(cursor.boundary_ids) > MAX_BOUNDARY_IDS:
+            logger.warning("%d documents at %s, only the last %d are excluded from the next page",
+                           len(cursor.boundary_ids), to_time_utc, MAX_BOUNDARY_IDS)
+            cursor.boundary_ids = cursor.boundary_ids[-MAX_BOUNDARY_IDS:]
+        return cursor
+
+    def apply(self, url):
+        """Extends the query of the url to exclude the documents already processed at the boundary"""
+        if len(self.boundary_ids) == 0:
+            return url
+
+        match = QUERY_PATTERN.search(url)
+        if match is None:
+            return url
+
+        language, query = match.groups()
+        ids = self.boundary_ids
+        if language == "kuery":
+            exclusion = "not _id:(" + " or ".join(f'"{i}"' for i in ids) + ")"
+            combinator = " and "
+        else:
+            exclusion = "NOT _id:(" + " OR ".join(f'"{i}"' for i in ids) + ")"
+            combinator = " AND "
+
+        exclusion = rison_escape(exclusion)
+        if query != "":
+            exclusion = "(" + query + ")" + combinator + exclusion
+
+        return url[:match.start()] + f"query:(language:{language},query:'{exclusion}')" + url[match.end():]
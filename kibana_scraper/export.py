@@ -0,0 +1,218 @@
+"""
+kibana_scraper/export.py
+
+Exports the records of the sections into one file, sorted by Timestamp
+
+The segments of the sections' stores are sorted by Timestamp once (the
+compacted ones already are), the records without a Timestamp last, then
+merged record by record into the output file, so the memory use doesn't grow
+with the data. The _index(Search type) column is added to each record on the
+way, and the records of a User ID stored by several runs are written only
+once: as the store normalizes the Timestamps, the copies of a record are next
+to each other.
+
+The format is chosen by the extension of the file: CSV, or with the optional
+pyarrow package, Parquet (.parquet) or Feather (.feather, .arrow). The
+binary formats are written export_row_group_size records at a time, with the
+types of the SCHEMA, and compressed with export_compression. As the records
+are sorted, the statistics of the Parquet row groups let the readers skip
+the ones outside of a Timestamp range.
+"""
+import os
+import csv
+import heapq
+from collections import Counter
+from contextlib import ExitStack
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from .config import config
+from .records import MEASURE_FIELDS
+from .store import SegmentStore, timestamp_key
+
+import logging
+logger = logging.getLogger(__name__)
+
+INDEX_FIELD = "_index(Search type)"
+
+FORMATS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".feather": "feather",
+    ".arrow": "feather",
+}
+
+# Types of the columns in the binary formats, the other columns are strings
+SCHEMA = {
+    "Timestamp": "timestamp",
+    "Age": "float64",
+    "Height": "float64",
+    "Weight": "float64",
+    "Waist": "float64",
+    "HbAc1": "float64",
+    "Diabetic": "int8",
+    "IsSmoker": "int8",
+    "Sex": "category",
+    "Status": "category",
+    "DeviceMake": "category",
+    INDEX_FIELD: "category",
+}
+SCHEMA.update({name: "measure" for name in MEASURE_FIELDS})
+
+
+def get_format(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unknown export format '{extension}', one of: {', '.join(FORMATS)}")
+    return FORMATS[extension]
+
+
+def open_segments(stack, store):
+    """Returns the readers of the segments of a store, sorting the unsorted ones first
+
+    The store is locked until the stack is closed, so the segments are not compacted meanwhile."""
+    stack.enter_context(store.lock)
+    readers = []
+    for name, segment in sorted(store.segments.items()):
+        if segment.rows == 0:
+            continue
+        if not segment.sorted:
+            logger.info("Sorting %s", name)
+            store.sort_segment(name)
+        f = stack.enter_context(open(os.path.join(store.folder, name), "r", newline=""))
+        reader = csv.DictReader(f)
+        if reader.fieldnames is not None:
+            readers.append(reader)
+    return readers
+
+
+def read_records(reader, section):
+    """Yields the sort key, the section and the row of the records of a segment"""
+    for row in reader:
+        yield timestamp_key(row.get("Timestamp", None) or ""), section, row
+
+
+def merge_records(readers, stats):
+    """Yields the rows of the segments in Timestamp order, without the copies of the same record"""
+    records = heapq.merge(*(read_records(reader, section) for section, reader in readers),
+                          key=lambda record: record[0])
+
+    # The copies of a record have the same Timestamp, so only the IDs of the current one are kept
+    current, user_ids = None, set()
+    for key, section, row in records:
+        if key != current:
+            current, user_ids = key, set()
+        user_id = (section, row["User ID"])
+        if user_id in user_ids:
+            stats["duplicates"] += 1
+            continue
+        user_ids.add(user_id)
+
+        row[INDEX_FIELD] = section
+        stats["written"] += 1
+        yield row
+
+
+def write_csv(file_path, fieldnames, rows):
+    with open(file_path, "w", newline="") as output:
+        writer = csv.DictWriter(output, fieldnames, restval="", extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def get_schema(fieldnames, measure_type):
+    types = {
+        "timestamp": pa.timestamp("ms", tz="UTC"),
+        "float64": pa.float64(),
+        "int8": pa.int8(),
+        "category": pa.dictionary(pa.int32(), pa.string()),
+        "measure": pa.float32() if measure_type == "float32" else pa.float64(),
+    }
+    return pa.schema([(name, types.get(SCHEMA.get(name, None), pa.string())) for name in fieldnames])
+
+
+def convert_column(values, field, categories):
+    """Returns the Arrow array of a column of CSV values
+
+    The dictionaries of the categorical columns only grow from one row group to the next (categories keeps the
+    values seen so far), so they can be written as deltas into the Feather files."""
+    values = pd.Series(values, dtype=object)
+    values[values == ""] = None
+    if pa.types.is_dictionary(field.type):
+        for value in values.dropna().unique():
+            if value not in categories:
+                categories[value] = len(categories)
+        indices = pa.array(values.map(categories), type=field.type.index_type, from_pandas=True)
+        return pa.DictionaryArray.from_arrays(indices, pa.array(list(categories), type=field.type.value_type))
+    elif pa.types.is_timestamp(field.type):
+        values = pd.to_datetime(values, utc=True, errors="coerce")
+    elif pa.types.is_floating(field.type) or pa.types.is_integer(field.type):
+        values = pd.to_numeric(values, errors="coerce")
+        if pa.types.is_integer(field.type):
+            values = values.astype("Int8")
+    return pa.array(values, type=field.type, from_pandas=True)
+
+
+def write_arrow(file_path, fieldnames, rows, file_format):
+    """Writes the rows into a Parquet or Feather file, row_group_size at a time"""
+    if pa is None:
+        raise RuntimeError(f"The {file_format} format requires the pyarrow package")
+
+    settings = config["DEFAULT"]
+    schema = get_schema(fieldnames, settings.get("export_float_type", "float64"))
+    compression = settings.get("export_compression", "zstd")
+    row_group_size = settings.getint("export_row_group_size", 100000)
+
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(file_path, schema, compression=compression, write_statistics=True)
+    else:
+        writer = pa.ipc.new_file(file_path, schema, options=pa.ipc.IpcWriteOptions(compression=compression,
+                                                                                   emit_dictionary_deltas=True))
+
+    categories = {field.name: {} for field in schema}
+
+    def write(columns):
+        arrays = [convert_column(column, field, categories[field.name]) for column, field in zip(columns, schema)]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    try:
+        columns = [[] for name in fieldnames]
+        for row in rows:
+            for column, name in zip(columns, fieldnames):
+                column.append(row.get(name, ""))
+            if len(columns[0]) >= row_group_size:
+                write(columns)
+                columns = [[] for name in fieldnames]
+        if len(columns[0]) > 0:
+            write(columns)
+    finally:
+        writer.close()
+
+
+def export_sections(sections, file_path):
+    """Merges the records of the sections into a file, returns the number of records written"""
+    file_format = get_format(file_path)
+    stats = Counter()
+    with ExitStack() as stack:
+        readers = [(section, reader) for section in sections
+                   for reader in open_segments(stack, SegmentStore.get(section))]
+
+        fieldnames = []
+        for section, reader in readers:
+            fieldnames.extend(name for name in reader.fieldnames if name not in fieldnames)
+        fieldnames.append(INDEX_FIELD)
+
+        rows = merge_records(readers, stats)
+        if file_format == "csv":
+            write_csv(file_path, fieldnames, rows)
+        else:
+            write_arrow(file_path, fieldnames, rows, file_format)
+
+    logger.info("Exported %d records of %d sections into %s, %d duplicates dropped",
+                stats["written"], len(sections), file_path, stats["duplicates"])
+    return stats["written"]
@@ -14,6 +14,7 @@ logger = logging.getLogger(__name__)
 WIDTH=400
 HEIGHT=300
 APP_TITLE="Kibana Scraper"
+EXPORT_FILE_TYPES=[("CSV", "*.csv"), ("Parquet", "*.parquet"), ("Feather", "*.feather")]
 
 class TextHandler(logging.Handler):
     # This class allows you to log to a Tkinter Text or ScrolledText widget
@@ -87,11 +88,6 @@ class RobotManager:
         self.parent.after(1000, self.update)
 
 
-
-root = tk.Tk()
-
-header_font = Font(family="Times New Roman", size=16)
-
 class Application(tk.Frame):
     def __init__(self, parent, *args, **kwargs):
         tk.Frame.__init__(self, parent, *args, **kwargs)
@@ -159,7 +155,8 @@ class ControlForm(tk.Frame):
 
     def export(self, *args, **kwargs):
         intial_filename = datetime.now().strftime("%Y%m%d-%H%M%S.csv")
-        file_path = tk.filedialog.asksaveasfilename(initialfile=intial_filename, defaultextension="csv")
+        file_path = tk.filedialog.asksaveasfilename(initialfile=intial_filename, defaultextension="csv",
+                                                    filetypes=EXPORT_FILE_TYPES)
         
         if file_path is not None and file_path != "" and file_path != ():
             try:
@@ -210,9 +207,16 @@ class ControlForm(tk.Frame):
 #canvas = tk.Canvas(root, width=WIDTH, height=HEIGHT)
 #canvas.place()
 
-content = Application(root)
-content.pack()
+# Guarded, because the worker processes of the pipeline and the measure engine
+# import the main module again, when they are spawned
+if __name__ == "__main__":
+    root = tk.Tk()
+
+    header_font = Font(family="Times New Roman", size=16)
+
+    content = Application(root)
+    content.pack()
 
-root.mainloop()
+    root.mainloop()
 
 
@@ -0,0 +1,49 @@
+"""
+kibana_scraper/locators.py
+
+Caches the page elements resolved by the robot
+
+The elements stay valid as long as the page is not reloaded, so they are kept
+until the next navigation, or until one of them turns out to be stale.
+"""
+from selenium.common.exceptions import StaleElementReferenceException
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LocatorCache:
+    def __init__(self):
+        self.elements = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, name, resolve):
+        """Returns the cached element, or resolves it with the given function"""
+        element = self.elements.get(name, None)
+        if element is not None:
+            try:
+                # Any call on a detached element raises StaleElementReferenceException
+                element.is_enabled()
+                self.hits += 1
+                return element
+            except StaleElementReferenceException:
+                # The page was re-rendered, the other elements are likely detached too
+                logger.debug("Stale element: %s", name)
+                self.invalidate()
+
+        self.misses += 1
+        element = resolve()
+        if element is not None:
+            self.elements[name] = element
+        return element
+
+    def invalidate(self):
+        """Drops all the cached elements, e.g. after navigation"""
+        if self.elements:
+            self.invalidations += 1
+        self.elements.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations}
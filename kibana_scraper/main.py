@@ -1,11 +1,20 @@
 from .config import config
 from .robot import Robot
+from .api import ApiRobot
 from .target import Target
 from .models import HPModel as Model
 from .signals import signals
+from . import shards
+from .measure_cache import MeasureCache, log_stats
+from . import measure_engine
+from . import store
+from . import archive
+from .export import export_sections
 
-import pandas as pd
+import queue
+import threading
 from datetime import datetime
+from contextlib import ExitStack
 
 import logging
 logger = logging.getLogger(__name__)
@@ -16,55 +25,140 @@ logging.basicConfig(level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def scrape(username, password):
-    done = set()
-    while True:
-        with Robot(username, password) as robot:
-            for section in config.sections():
-                if signals.stop:
-                    print("Good bye!")
-                    return
+ENGINES = {
+    "browser": Robot,
+    "api": ApiRobot,
+}
+
 
-                if section in done:
+class Worker(threading.Thread):
+    """Takes targets and shards from the queue and scrapes them with its own robots
+
+    The queue holds (section, shard) tuples. A section, which is configured to be
+    sharded, is first queued without a shard: the worker taking it splits it up and
+    queues its shards."""
+
+    def __init__(self, index, tasks, done, username, password):
+        super().__init__(name=f"worker-{index}")
+        self.index = index
+        self.tasks = tasks
+        self.done = done
+        self.username = username
+        self.password = password
+        self.robots = {}
+
+    def run(self):
+        with ExitStack() as stack:
+            while not signals.stop:
+                try:
+                    section, shard = self.tasks.get(timeout=1)
+                except queue.Empty:
+                    # Other workers may still be queueing shards
+                    if self.tasks.unfinished_tasks == 0:
+                        return
                     continue
-                    
-                enabled = config[section].getboolean("enabled", True)
-
-                if enabled:
-                    print("Target:", section)
-                    with Target(section, config[section], Model) as target:
-                        try:
-                            robot.go(target)
-                            done.add(section)
-                            
-                        except Exception as robot_exception:
-                            logger.critical(robot_exception, exc_info=True)
-                            try:
-                                robot.screenshot()
-                            except Exception as screenshot_exception:
-                                logger.critical("Failed to save screenshot. Geckodriver is possibly crashed.")
-                            
-                            continue
-                else:
-                    print(f"Section {section} is disabled. Skipping.")
-                    done.add(section)
-                    
+
+                try:
+                    self.process(stack, section, shard)
+                finally:
+                    self.tasks.task_done()
+
+    def get_robot(self, stack, section):
+        """Returns the robot of the section's engine, started on demand"""
+        engine = config[section].get("engine", "browser")
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{engine}' in section {section}")
+
+        if engine not in self.robots:
+            self.robots[engine] = stack.enter_context(ENGINES[engine](self.username, self.password, self.index))
+        return self.robots[engine]
+
+    def process(self, stack, section, shard):
+        try:
+            robot = self.get_robot(stack, section)
+
+            if shard is None:
+                planned = shards.plan(section, config[section], robot)
+                if planned is not None:
+                    group, pending = planned
+                    for section_shard in pending:
+                        self.tasks.put((section, section_shard))
+                    if len(pending) == 0:
+                        # Every shard has been completed by previous runs
+                        self.merge_shards(section, group)
+                    return
+        except Exception as robot_exception:
+            logger.critical(robot_exception, exc_info=True)
             return
 
+        if shard is None:
+            print("Target:", section)
+        else:
+            print("Target:", section, "shard:", shard.name)
+
+        success = False
+        with Target(section, config[section], Model, shard) as target:
+            try:
+                robot.go(target)
+                success = True
+
+            except Exception as robot_exception:
+                logger.critical(robot_exception, exc_info=True)
+                try:
+                    robot.screenshot()
+                except Exception as screenshot_exception:
+                    logger.critical("Failed to save screenshot. Geckodriver is possibly crashed.")
+
+        if shard is None:
+            if success:
+                self.done.add(section)
+        elif shard.group.complete(success and not signals.stop):
+            self.merge_shards(section, shard.group)
+
+    def merge_shards(self, section, group):
+        group.merge(datetime.now().strftime(section + "-%Y%m%d-%H%M%S.csv"))
+        self.done.add(section)
+
+
+def scrape(username, password):
+    done = set()
+    tasks = queue.Queue()
 
-def export(file_path):
-    cache = []
     for section in config.sections():
         enabled = config[section].getboolean("enabled", True)
 
         if enabled:
-            target = Target(section, config[section])
-            if target.record_cache is not None:
-                section_results = target.record_cache.assign(**{"_index(Search type)":section})
-                cache.append(section_results)
-            
-    df = pd.concat(cache)
-    df.sort_values(["Timestamp"], inplace=True)
-    
-    df.to_csv(file_path, index=False)
-    
+            tasks.put((section, None))
+        else:
+            print(f"Section {section} is disabled. Skipping.")
+            done.add(section)
+
+    measure_cache = MeasureCache.get()
+    measure_stats = None if measure_cache is None else measure_cache.stats()
+
+    # Every worker runs its own browser
+    worker_count = max(1, config["DEFAULT"].getint("workers", 1))
+    workers = [Worker(i, tasks, done, username, password) for i in range(worker_count)]
+
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        # join with timeout, so the main thread can still receive the signals
+        while worker.is_alive():
+            worker.join(1)
+
+    measure_engine.shutdown()
+    store.shutdown()
+    archive.shutdown()
+    if measure_cache is not None:
+        log_stats(measure_cache, measure_stats)
+
+    if signals.stop:
+        print("Good bye!")
+
+    return done
+
+
+def export(file_path):
+    sections = [section for section in config.sections() if config[section].getboolean("enabled", True)]
+    export_sections(sections, file_path)
@@ -0,0 +1,254 @@
+"""
+kibana_scraper/measure_cache.py
+
+Keeps the calculated measures between runs
+
+The measures are stored in an SQLite database (cache/measures.sqlite), keyed
+by a hash of the time and amplitude arrays, and of the model: its class, the
+source code of its module and of the package modules it uses (e.g. the
+preprocessing), the versions of the libraries calculating the measures and
+the model parameters. A change of any of them makes a new key, and the entries of the earlier
+versions of a model are removed when the model is first used.
+
+The least recently used entries are evicted, when the entries exceed
+measure_cache_size MB. The hit and miss counts are kept in the database too,
+so they add up over runs and processes.
+
+Usage:
+    python -m kibana_scraper.measure_cache [stats|clear]
+"""
+import os
+import sys
+import time
+import pickle
+import sqlite3
+import hashlib
+import inspect
+import threading
+import numpy as np
+import scipy
+import statsmodels
+import heartpy as hp
+
+from .config import config
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join("cache", "measures.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS measures (
+    key BLOB PRIMARY KEY,
+    model TEXT NOT NULL,
+    version TEXT NOT NULL,
+    measures BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS measures_last_used ON measures (last_used);
+CREATE INDEX IF NOT EXISTS measures_model ON measures (model, version);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+STATS = ("hits", "misses", "stores", "evictions", "invalidations", "size")
+
+# Entries are evicted until the size is under this fraction of the limit
+EVICTION_TARGET = 0.9
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def hash_array(digest, values):
+    array = np.ascontiguousarray(values)
+    digest.update(array.dtype.str.encode())
+    digest.update(str(array.shape).encode())
+    digest.update(array.tobytes())
+
+
+def get_modules(module):
+    """Returns a module, and the modules of this package it uses, in name order"""
+    package = __name__.rpartition(".")[0] + "."
+    modules = {module.__name__: module}
+    for value in vars(module).values():
+        name = value.__name__ if inspect.ismodule(value) else getattr(value, "__module__", None)
+        if isinstance(name, str) and name.startswith(package) and name in sys.modules:
+            modules[name] = sys.modules[name]
+    return [modules[name] for name in sorted(modules)]
+
+
+class MeasureCache:
+    def __init__(self, path=DEFAULT_PATH, max_size=256):
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.versions = {}
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.executemany("INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)",
+                                    [(name,) for name in STATS])
+
+    @staticmethod
+    def get():
+        """Returns the cache of the process, or None if measure_cache is disabled"""
+        global _cache
+        if not config["DEFAULT"].getboolean("measure_cache", True):
+            return None
+
+        with _cache_lock:
+            # A forked process can't use the connection of its parent
+            if _cache is None or _cache[0] != os.getpid():
+                cache = MeasureCache(config["DEFAULT"].get("measure_cache_path", DEFAULT_PATH),
+                                     config["DEFAULT"].getint("measure_cache_size", 256))
+                _cache = (os.getpid(), cache)
+            return _cache[1]
+
+    def transaction(self, function, *args):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(*args)
+                self.connection.execute("COMMIT")
+                return result
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def count(self, name, value=1):
+        self.connection.execute("UPDATE stats SET value = value + ? WHERE name = ?", (value, name))
+
+    def get_version(self, model):
+        """Returns the version of the model, and removes the entries of its other versions on first use"""
+        name = model.__module__ + "." + model.__qualname__
+        if name not in self.versions:
+            digest = hashlib.sha256()
+            for module in get_modules(sys.modules[model.__module__]):
+                digest.update(inspect.getsource(module).encode())
+            for library in (hp, scipy, statsmodels, np):
+                digest.update(library.__version__.encode())
+            digest.update(repr(sorted(model.get_parameters().items())).encode())
+            version = digest.hexdigest()
+
+            def invalidate():
+                removed, size = self.connection.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM measures WHERE model = ? AND version != ?",
+                    (name, version)).fetchone()
+                if removed > 0:
+                    self.connection.execute("DELETE FROM measures WHERE model = ? AND version != ?", (name, version))
+                    self.count("invalidations", removed)
+                    self.count("size", -size)
+                return removed
+
+            removed = self.transaction(invalidate)
+            if removed > 0:
+                logger.info("Removed %d cached measures of the earlier versions of %s", removed, name)
+            self.versions[name] = version
+        return name, self.versions[name]
+
+    def key(self, model, time, amplitude):
+        name, version = self.get_version(model)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(version.encode())
+        hash_array(digest, time)
+        hash_array(digest, amplitude)
+        return digest.digest()
+
+    def lookup(self, key):
+        """Returns the cached measures, or None"""
+        def lookup():
+            row = self.connection.execute("SELECT measures FROM measures WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.count("misses")
+                return None
+
+            self.connection.execute("UPDATE measures SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.count("hits")
+            return pickle.loads(row[0])
+
+        return self.transaction(lookup)
+
+    def store(self, key, model, measures):
+        name, version = self.get_version(model)
+        value = pickle.dumps(measures, protocol=pickle.HIGHEST_PROTOCOL)
+        size = len(key) + len(value)
+
+        def store():
+            inserted = self.connection.execute(
+                "INSERT OR IGNORE INTO measures (key, model, version, measures, size, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, name, version, value, size, time.time())).rowcount
+            if inserted > 0:
+                self.count("stores")
+                self.count("size", size)
+                self.evict()
+
+        self.transaction(store)
+
+    def evict(self):
+        """Removes the least recently used entries, while the cache is over its size"""
+        total = self.connection.execute("SELECT value FROM stats WHERE name = 'size'").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        rows = self.connection.execute("SELECT key, size FROM measures ORDER BY last_used").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_size * EVICTION_TARGET:
+                break
+            evicted.append((key,))
+            total -= size
+
+        self.connection.executemany("DELETE FROM measures WHERE key = ?", evicted)
+        self.connection.execute("UPDATE stats SET value = ? WHERE name = 'size'", (total,))
+        self.count("evictions", len(evicted))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.connection.execute("SELECT name, value FROM stats").fetchall())
+            stats["entries"] = self.connection.execute("SELECT COUNT(*) FROM measures").fetchone()[0]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        return stats
+
+    def clear(self):
+        def clear():
+            self.connection.execute("DELETE FROM measures")
+            self.connection.execute("UPDATE stats SET value = 0")
+        self.transaction(clear)
+        self.versions = {}
+
+
+def log_stats(cache, before=None):
+    """Logs the statistics of the cache, since the before snapshot if given"""
+    stats = cache.stats()
+    if before is not None:
+        for name in ("hits", "misses", "stores", "evictions", "invalidations"):
+            stats[name] -= before[name]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+
+    logger.info("Measure cache: %d hits, %d misses (%.1f%% hit rate), %d stored, %d evicted, %d invalidated, "
+                "%d entries, %.1f MB", stats["hits"], stats["misses"], 100 * stats["hit_rate"], stats["stores"],
+                stats["evictions"], stats["invalidations"], stats["entries"], stats["size"] / 1024 / 1024)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    cache = MeasureCache(config["DEFAULT"].get("measure_cache_path", DEFAULT_PATH),
+                         config["DEFAULT"].getint("measure_cache_size", 256))
+    if command == "clear":
+        cache.clear()
+        print("Measure cache cleared:", cache.path)
+    elif command == "stats":
+        for name, value in cache.stats().items():
+            print(f"{name}: {value}")
+    else:
+        print(__doc__)
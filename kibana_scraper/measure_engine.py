@@ -0,0 +1,283 @@
+"""
+kibana_scraper/measure_engine.py
+
+Calculates the measures in worker processes, isolated from the scraper
+
+Every worker process is driven by a thread of the engine, which sends it one
+signal at a time and waits for the measures up to measure_timeout seconds. A
+worker, which runs out of time, or crashes, is killed and replaced, and the
+record gets the reason of the failure instead of the measures. The address
+space of the workers can be limited to measure_memory_limit MB (where the
+resource module is available), and they are replaced after
+measure_worker_tasks records, so leaked memory is given back.
+
+The workers ignore SIGINT, the scraper stops them. A worker lost while the
+scraper is stopping raises MeasuresCancelled instead of giving a failure, so
+the record is not stored, and it is scraped again by the next run.
+"""
+import os
+import queue
+import atexit
+import signal
+import threading
+import multiprocessing
+from collections import namedtuple, Counter
+from concurrent.futures import Future
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from .config import config
+from .signals import signals
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The process id and the engine started in it
+_engine = None
+_engine_lock = threading.Lock()
+
+
+class MeasureFailure(namedtuple("MeasureFailure", ["kind", "detail"])):
+    """The reason, why the measures of a record could not be calculated
+
+    kind is one of: error, memory, timeout, crashed"""
+
+    def __str__(self):
+        return f"{self.kind}: {self.detail}"
+
+
+class MeasuresCancelled(Exception):
+    """The measures were not calculated, as the scraper is stopping"""
+
+
+def get_failure(exception):
+    if isinstance(exception, MemoryError):
+        return MeasureFailure("memory", str(exception) or "out of memory")
+    return MeasureFailure("error", f"{type(exception).__name__}: {exception}")
+
+
+def run_model(instance):
+    """Returns the measures of a model instance and None, or None and the MeasureFailure"""
+    try:
+        working_data, measures = instance.get_measures()
+        return measures, None
+    except Exception as e:
+        return None, get_failure(e)
+
+
+def compute_measures(model, time, amplitude):
+    """Runs the model, returns the measures and None, or None and the MeasureFailure"""
+    try:
+        instance = model(time, amplitude)
+    except Exception as e:
+        return None, get_failure(e)
+    return run_model(instance)
+
+
+def limit_memory(memory_limit):
+    if memory_limit <= 0:
+        return
+    if resource is None:
+        logger.warning("measure_memory_limit is not supported on this platform")
+        return
+    limit = memory_limit * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+# Time for a new worker process to import the models, not counted in the time of the records
+STARTUP_TIMEOUT = 120
+
+
+def serve(connection, memory_limit):
+    """Main function of the worker processes"""
+    # Ctrl+C reaches the whole process group, the parent stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    limit_memory(memory_limit)
+    from . import models
+    connection.send("ready")
+
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        connection.send(compute_measures(*task))
+
+
+class Slot(threading.Thread):
+    """Runs the tasks of the engine in its worker process, and replaces the process when needed"""
+
+    def __init__(self, engine, index):
+        super().__init__(name=f"measure-worker-{index}", daemon=True)
+        self.engine = engine
+        self.process = None
+        self.connection = None
+        self.tasks_done = 0
+
+    def start_process(self):
+        self.connection, child_connection = self.engine.context.Pipe()
+        self.process = self.engine.context.Process(target=serve, args=(child_connection, self.engine.memory_limit),
+                                                   name=self.name, daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.tasks_done = 0
+
+        try:
+            if self.connection.poll(STARTUP_TIMEOUT) and self.connection.recv() == "ready":
+                return
+        except (EOFError, OSError):
+            pass
+        self.process.join(1)
+        raise RuntimeError(f"worker failed to start, exit code {self.process.exitcode}")
+
+    def stop_process(self, kill=False):
+        if self.process is None:
+            return
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+        self.process = None
+
+    def run(self):
+        while True:
+            item = self.engine.tasks.get()
+            if item is None:
+                self.stop_process()
+                return
+
+            future, task = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = self.execute(task)
+                except MeasuresCancelled as e:
+                    future.set_exception(e)
+                    continue
+                except Exception as e:
+                    logger.critical("Measure worker failed: %s", e, exc_info=True)
+                    result = None, MeasureFailure("error", f"{type(e).__name__}: {e}")
+                future.set_result(result)
+
+    def execute(self, task):
+        if self.process is None or self.tasks_done >= self.engine.max_tasks > 0:
+            # Recycled after max_tasks, so leaked memory is given back
+            self.stop_process()
+            try:
+                self.start_process()
+            except RuntimeError as e:
+                self.stop_process(kill=True)
+                if self.engine.closing or signals.stop:
+                    raise MeasuresCancelled(str(e))
+                return None, MeasureFailure("crashed", str(e))
+
+        try:
+            self.connection.send(task)
+            if self.connection.poll(self.engine.timeout):
+                measures, failure = self.connection.recv()
+                self.tasks_done += 1
+                if failure is not None and failure.kind == "memory":
+                    # Its state can't be trusted after a MemoryError
+                    self.stop_process(kill=True)
+                return measures, failure
+        except (EOFError, OSError):
+            self.process.join(1)
+            exitcode = self.process.exitcode
+            self.stop_process(kill=True)
+            if self.engine.closing or signals.stop:
+                raise MeasuresCancelled(f"worker exited with code {exitcode} while stopping")
+            return None, MeasureFailure("crashed", f"worker exited with code {exitcode}")
+
+        self.stop_process(kill=True)
+        return None, MeasureFailure("timeout", f"no result in {self.engine.timeout} s")
+
+
+class MeasureEngine:
+    def __init__(self, workers, timeout=60, memory_limit=0, max_tasks=100):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.max_tasks = max_tasks
+        self.closing = False
+        # Forking the multithreaded scraper is not safe
+        self.context = multiprocessing.get_context("spawn")
+        self.tasks = queue.Queue()
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.slots = [Slot(self, i) for i in range(workers)]
+        for slot in self.slots:
+            slot.start()
+
+    @staticmethod
+    def get():
+        """Returns the engine of the process, or None if measure_workers is 0"""
+        global _engine
+        workers = config["DEFAULT"].getint("measure_workers", 0)
+        if workers <= 0:
+            return None
+
+        with _engine_lock:
+            # The threads of the engine are not running in a forked process
+            if _engine is None or _engine[0] != os.getpid():
+                engine = MeasureEngine(workers,
+                                       config["DEFAULT"].getfloat("measure_timeout", 60),
+                                       config["DEFAULT"].getint("measure_memory_limit", 0),
+                                       config["DEFAULT"].getint("measure_worker_tasks", 100))
+                atexit.register(engine.close)
+                _engine = (os.getpid(), engine)
+            return _engine[1]
+
+    def submit(self, model, time, amplitude):
+        """Queues a signal, returns a Future of its measures and failure"""
+        future = Future()
+        future.add_done_callback(self.count)
+        self.tasks.put((future, (model, time, amplitude)))
+        return future
+
+    def count(self, future):
+        if future.exception() is not None:
+            with self.stats_lock:
+                self.stats["cancelled"] += 1
+            return
+        measures, failure = future.result()
+        with self.stats_lock:
+            self.stats["ok" if failure is None else failure.kind] += 1
+
+    def calculate(self, model, time, amplitude):
+        return self.submit(model, time, amplitude).result()
+
+    def close(self):
+        self.closing = True
+        for slot in self.slots:
+            self.tasks.put(None)
+        for slot in self.slots:
+            slot.join(10)
+        self.slots = []
+
+    def log_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        logger.info("Measure engine: %s", ", ".join(f"{count} {kind}" for kind, count in sorted(stats.items())) or "idle")
+
+
+def shutdown():
+    """Stops the engine of the process, if it was started, and logs its statistics"""
+    global _engine
+    with _engine_lock:
+        started, _engine = _engine, None
+    if started is not None and started[0] == os.getpid():
+        engine = started[1]
+        engine.close()
+        engine.log_stats()
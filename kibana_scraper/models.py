@@ -1,8 +1,15 @@
+import os
+import math
+import threading
+import multiprocessing
+import numpy as np
 import pandas as pd
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 from statsmodels.tsa.seasonal import STL
 import heartpy as hp
-from scipy.signal import resample
 from .config import config
+from .preprocessing import get_preprocessor
 
 
 import logging
@@ -11,46 +18,193 @@ logger = logging.getLogger(__name__)
 import warnings
 warnings.filterwarnings('ignore')
 
+def as_float_array(values):
+    """Returns the values as a float array, without a copy if they already are one"""
+    array = np.asarray(values)
+    return array if array.dtype.kind == "f" else array.astype(np.float64)
+
+
 class BaseModel:
+    """The signal of a record, as arrays of the time in seconds and the amplitude
+
+    The arrays decoded from the documents are used as they are, the DataFrame
+    view of the signal is only created when it is accessed."""
+
     def __init__(self, time, amplitude):
-        self.time = pd.to_timedelta(time, unit='seconds')
-        self.amplitude = amplitude
-        self.df = pd.DataFrame(list(zip(self.time, self.amplitude)))
-        self.df.columns = ["time", "amplitude"]
-        self.df.set_index("time", inplace=True)
+        self.time = as_float_array(time)
+        self.amplitude = as_float_array(amplitude)
+        self._df = None
+        # The preprocessed signal and its sample rate, if prepared by prepare_batch
+        self.preprocessed = None
+
+    @staticmethod
+    def get_parameters():
+        """The options the measures depend on, the cached measures are invalidated when they change"""
+        return {}
+
+    @staticmethod
+    def prepare_batch(models):
+        """Prepares the models of many records at once, before their measures are calculated"""
+        pass
+
+    @property
+    def df(self):
+        """The amplitude indexed by the time, as timedelta"""
+        if self._df is None:
+            index = pd.TimedeltaIndex(pd.to_timedelta(self.time, unit="seconds"), name="time")
+            self._df = pd.DataFrame({"amplitude": self.amplitude}, index=index)
+        return self._df
 
     def get_sample_rate(self):
         """Calculates sample rate"""
-        sample_rate = hp.get_samplerate_mstimer(self.time.total_seconds() * 1000)
+        sample_rate = hp.get_samplerate_mstimer(self.time * 1000)
         return sample_rate
 
 
-class STLNormalizationModel(BaseModel):
-    def _get_period_score(self, period):
-        result = STL(self.df.amplitude, period=period).fit()
-        try:
-            working_data, measures = hp.process((result.resid + result.seasonal + result.weights).to_numpy(),
-                                                self.get_sample_rate(), calc_freq=True)
-            return len(working_data["binary_peaklist"]), sum(working_data["binary_peaklist"])
-        except:
-            return None, None
+# Candidate periods of the STL decomposition
+STL_PERIODS = range(20, 60)
 
-    def _get_best_period(self):
-        """Finds the period with the best accepted/rejected peak ratio"""
-        results = []
-        for i in range(20, 60):
-            l, s = self._get_period_score(i)
-            if l is not None:
-                results.append((i, l, s))
+# The process id and the pool started in it
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the process pool evaluating the STL periods in parallel, or None if stl_workers is 0"""
+    global _executor
+    workers = config["DEFAULT"].getint("stl_workers", 0)
+    if workers <= 0:
+        return None
+    with _executor_lock:
+        # The pool of the parent is not usable in a forked process
+        if _executor is None or _executor[0] != os.getpid():
+            _executor = (os.getpid(), ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")))
+        return _executor[1]
+
+
+def normalize(amplitude, period):
+    """Returns the signal normalized by the STL decomposition with the given period"""
+    result = STL(amplitude, period=period).fit()
+    return np.asarray(result.resid + result.seasonal + result.weights)
+
+
+def score_period(amplitude, period, sample_rate):
+    """Returns the accepted/rejected peak ratio of the signal normalized with the period, and the normalized signal
+
+    The score is None, if HeartPy can't process the signal. Only the peaks are
+    needed, so the frequency domain measures are not calculated."""
+    signal = normalize(amplitude, period)
+    try:
+        working_data, measures = hp.process(signal, sample_rate)
+    except:
+        return None, signal
+
+    peaks = len(working_data["binary_peaklist"])
+    rejected = peaks - sum(working_data["binary_peaklist"])
+    return (math.inf if rejected == 0 else peaks / rejected), signal
+
+
+class PeriodSearch:
+    """Finds the STL period with the best accepted/rejected peak ratio
+
+    Each period is fitted once, the results are kept, so the normalized signal
+    of the best period is reused for the measures. On equal scores, the shorter
+    period wins, as with the exhaustive search."""
 
-        x = [r[0] for r in results]
-        y = [(r[1] / (r[1] - r[2])) for r in results]
+    def __init__(self, amplitude, sample_rate, periods=STL_PERIODS, executor=None):
+        self.amplitude = amplitude
+        self.sample_rate = sample_rate
+        self.periods = periods
+        self.executor = executor
+        self.results = {}
+
+    def evaluate(self, periods):
+        missing = [period for period in dict.fromkeys(periods) if period not in self.results]
+        if len(missing) == 0:
+            return
+
+        map_ = map if self.executor is None or len(missing) == 1 else self.executor.map
+        results = map_(score_period, repeat(self.amplitude), missing, repeat(self.sample_rate))
+        for period, result in zip(missing, results):
+            self.results[period] = result
+
+    def score(self, period):
+        score = self.results[period][0]
+        return -math.inf if score is None else score
+
+    def signal(self, period):
+        """The signal normalized with an evaluated period"""
+        return self.results[period][1]
+
+    def rank(self, periods):
+        """The periods with a score, best first"""
+        scored = [period for period in periods if self.results[period][0] is not None]
+        return sorted(scored, key=lambda period: (-self.score(period), period))
+
+    def best(self):
+        ranked = self.rank(self.results.keys())
+        if len(ranked) == 0:
+            raise ValueError("No STL period could be scored")
+        return ranked[0]
+
+    def exhaustive(self):
+        """Evaluates every period"""
+        self.evaluate(self.periods)
+        return self.best()
+
+    def coarse_to_fine(self, step, candidates):
+        """Evaluates every step-th period, then all the periods around the best candidates"""
+        coarse = list(self.periods[::step])
+        self.evaluate(coarse)
+
+        fine = [period for candidate in self.rank(coarse)[:candidates]
+                for period in range(candidate - step + 1, candidate + step) if period in self.periods]
+        self.evaluate(fine)
+        return self.best()
+
+    def golden_section(self):
+        """Narrows the range of the periods by golden-section search, assuming a single peak of the score"""
+        low, high = 0, len(self.periods) - 1
+        ratio = (math.sqrt(5) - 1) / 2
+        while high - low > 2:
+            a = high - round((high - low) * ratio)
+            b = low + round((high - low) * ratio)
+            if a >= b:
+                a, b = b - 1, b
+            self.evaluate([self.periods[a], self.periods[b]])
+            if self.score(self.periods[a]) >= self.score(self.periods[b]):
+                high = b
+            else:
+                low = a
 
-        best_score = max(y)
-        best_score_index = y.index(best_score)
-        best_period = x[best_score_index]
+        self.evaluate(self.periods[low:high + 1])
+        return self.best()
 
-        return best_period
+    def run(self, method):
+        if method == "exhaustive":
+            return self.exhaustive()
+        elif method == "coarse":
+            return self.coarse_to_fine(config["DEFAULT"].getint("stl_period_step", 3),
+                                       config["DEFAULT"].getint("stl_period_candidates", 2))
+        elif method == "golden":
+            return self.golden_section()
+        else:
+            raise ValueError("Unknown stl_period_search method: " + method)
+
+
+class STLNormalizationModel(BaseModel):
+    @staticmethod
+    def get_parameters():
+        return {name: config["DEFAULT"].get(name, None)
+                for name in ("calculate_measures", "stl_period_search", "stl_period_step", "stl_period_candidates")}
+
+    def get_period_search(self):
+        return PeriodSearch(self.amplitude, self.get_sample_rate(), executor=get_executor())
+
+    def _get_best_period(self, search=None):
+        """Finds the period with the best accepted/rejected peak ratio"""
+        search = search or self.get_period_search()
+        return search.run(config["DEFAULT"].get("stl_period_search", "exhaustive"))
 
     def get_measures(self):
         """Calculates measures using HeartPy"""
@@ -58,26 +212,41 @@ class STLNormalizationModel(BaseModel):
         if not config["DEFAULT"].getboolean("calculate_measures", True):
             return None, None
             
-        sample_rate = self.get_sample_rate()
-        best_period = self._get_best_period()
+        search = self.get_period_search()
+        best_period = self._get_best_period(search)
 
-        result = STL(self.df.amplitude, period=best_period).fit()
-        return hp.process((result.resid + result.seasonal + result.weights).to_numpy(), sample_rate,
-                          calc_freq=True)
+        # The signal of the best period was already normalized by the search
+        return hp.process(search.signal(best_period), search.sample_rate, calc_freq=True)
 
 
 class HPModel(BaseModel):
-    def process(self, sample_rate):
-        data = self.df.amplitude.to_numpy()
+    @staticmethod
+    def get_parameters():
+        return {name: config["DEFAULT"].get(name, None)
+                for name in ("preprocessing", "bandpass", "filter_order", "smooth_window", "resample_rate")}
 
-        data = hp.filter_signal(data, [0.6, 3.6], sample_rate, order=3, filtertype='bandpass')
+    @staticmethod
+    def prepare_batch(models):
+        """Preprocesses the signals of the models together"""
+        prepared = []
+        for model in models:
+            try:
+                prepared.append((model, model.get_sample_rate()))
+            except Exception:
+                # Fails again in get_measures, with its own error
+                pass
 
-        data = hp.smooth_signal(data, sample_rate, window_length=15)
+        results = get_preprocessor().apply_batch([model.amplitude for model, sample_rate in prepared],
+                                                 [sample_rate for model, sample_rate in prepared])
+        for (model, sample_rate), result in zip(prepared, results):
+            model.preprocessed = result
+
+    def process(self, sample_rate):
+        if self.preprocessed is None:
+            data, sample_rate = get_preprocessor().apply(self.amplitude, sample_rate)
+        else:
+            data, sample_rate = self.preprocessed
 
-        sample_ratio = (100/sample_rate)+1
-        data = resample(data, len(data) * 1)
-        sample_rate = sample_rate * 1
-        
         return hp.process(data, sample_rate,
                           calc_freq=True, clean_rr=True)
         
@@ -0,0 +1,155 @@
+"""
+kibana_scraper/pipeline.py
+
+Moves the parsing and the measure calculation of the documents out of the robot's thread
+
+The robot submits the raw JSON documents, which are parsed, and their measures
+calculated, by a pool of worker processes. A writer thread stores the results
+through the target, in submission order, or as they complete.
+
+At most max_pending documents are in the pipeline at a time, the robot is
+blocked on submit until a slot frees up. Batches of documents are processed
+as one task, and take as many slots as they have documents.
+
+A task that fails in the pool (e.g. its worker process crashed) is processed
+again by the writer thread. If it fails again, its documents are not marked
+as seen, so they are scraped again when they come up. A new pool is started,
+when a crashed worker left the pool broken.
+
+The workers ignore SIGINT, so on Ctrl+C the documents submitted so far are
+still processed and written, while the pipeline drains.
+"""
+import queue
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .records import RecordFactory
+from .measure_engine import MeasuresCancelled
+from .signals import signals
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def ignore_interrupt():
+    """Initializer of the workers, Ctrl+C reaches the whole process group, the scraper stops them"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def process_document(model, document):
+    """Runs in the worker processes. Returns the fields of the record, measures included"""
+    record = RecordFactory.loads(model, document)
+    return {key: record[key] for key in record.keys()}
+
+
+def process_batch(model, documents):
+    """Runs in the worker processes. Returns the fieldnames and the rows of the records, measures included"""
+    batch = RecordFactory.load_batch(model, documents)
+    batch.calculate_measures()
+    return batch.fieldnames, batch.rows()
+
+
+class Pipeline:
+    def __init__(self, target, workers, max_pending, ordered=True):
+        self.target = target
+        self.ordered = ordered
+        self.workers = workers
+        self.executor = None
+        self.start_executor()
+        self.max_pending = max_pending
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.results = queue.Queue()
+        self.writer = threading.Thread(target=self.write, name=f"writer-{target.section}")
+        self.writer.start()
+
+    def start_executor(self):
+        # Forking the multithreaded scraper is not safe
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=ignore_interrupt)
+
+    def submit_task(self, function, *args):
+        """Submits a task to the pool, starting a new one if a crashed worker broke it
+
+        The tasks of the broken pool fail, and are processed again by the writer."""
+        try:
+            return self.executor.submit(function, *args)
+        except BrokenProcessPool:
+            logger.error("A pipeline worker crashed, starting a new pool")
+            self.executor.shutdown(wait=False)
+            self.start_executor()
+            return self.executor.submit(function, *args)
+
+    def reserve(self, count):
+        """Blocks until count documents fit in the pipeline. A batch larger than the pipeline waits for it to be empty"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0 or self.pending + count <= self.max_pending)
+            self.pending += count
+
+    def enqueue(self, future, store, user_ids, retry):
+        """Queues the result of a task for the writer, which calls store with it, or with retry() if it failed"""
+        item = (future, store, user_ids, retry)
+        if self.ordered:
+            self.results.put(item)
+        else:
+            future.add_done_callback(lambda future: self.results.put(item))
+
+    def submit(self, document, user_id):
+        """Queues a document for processing, blocks while the pipeline is full"""
+        self.reserve(1)
+        future = self.submit_task(process_document, self.target.model, document)
+        self.enqueue(future, lambda data: self.target.store_document(data, document, user_id), [user_id],
+                     lambda: process_document(self.target.model, document))
+
+    def submit_batch(self, documents, user_ids):
+        """Queues documents for processing as a single batch, blocks while the pipeline is full"""
+        self.reserve(len(documents))
+        future = self.submit_task(process_batch, self.target.model, documents)
+        self.enqueue(future, lambda result: self.target.store_batch(*result, documents, user_ids), user_ids,
+                     lambda: process_batch(self.target.model, documents))
+
+    def write(self):
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+
+            future, store, user_ids, retry = item
+            try:
+                try:
+                    result = future.result()
+                except MeasuresCancelled:
+                    raise
+                except Exception as e:
+                    if signals.stop:
+                        raise MeasuresCancelled(str(e)) from e
+                    logger.error("Failed to process %s in the pipeline, retrying: %s", ", ".join(user_ids), e)
+                    result = retry()
+                store(result)
+                for user_id in user_ids:
+                    logger.info("Stored: %s", user_id)
+            except MeasuresCancelled as e:
+                logger.warning("Not stored, as the scraper is stopping: %s (%s)", ", ".join(user_ids), e)
+            except Exception as e:
+                logger.critical("Failed to process %s: %s", ", ".join(user_ids), e, exc_info=True)
+            finally:
+                # Seen, if they were stored
+                self.target.release(user_ids)
+                with self.condition:
+                    self.pending -= len(user_ids)
+                    self.condition.notify_all()
+
+    def flush(self):
+        """Waits until the documents submitted so far are written"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+
+    def close(self):
+        """Waits until the submitted documents are processed and written"""
+        # All the done callbacks have run, when shutdown returns
+        self.executor.shutdown(wait=True)
+        self.results.put(None)
+        self.writer.join()
@@ -0,0 +1,110 @@
+"""
+kibana_scraper/preprocessing.py
+
+Preprocessing of the signals before the peak detection
+
+The stages are configured by the preprocessing option, and applied in order:
+    bandpass: Butterworth band-pass filter, forward and backward, as hp.filter_signal
+    smooth: Savitzky-Golay filter, as hp.smooth_signal
+    resample: resampling to resample_rate Hz, if it is set
+    detrend: removal of the linear trend
+
+The filters are designed once for each sample rate, band and order, as
+second-order sections. The signals of the same length and sample rate are
+processed together, as the rows of a 2D array.
+"""
+from functools import lru_cache
+import numpy as np
+from scipy.signal import butter, sosfiltfilt, savgol_filter, resample, detrend
+
+from .config import config
+
+import logging
+logger = logging.getLogger(__name__)
+
+STAGES = ("bandpass", "smooth", "resample", "detrend")
+
+
+@lru_cache(maxsize=256)
+def design_bandpass(sample_rate, low, high, order):
+    """Returns the second-order sections of the band-pass filter"""
+    nyquist = 0.5 * sample_rate
+    return butter(order, [low / nyquist, high / nyquist], btype="band", output="sos")
+
+
+class Preprocessor:
+    def __init__(self, stages=("bandpass", "smooth"), band=(0.6, 3.6), order=3, smooth_window=15,
+                 resample_rate=0):
+        for stage in stages:
+            if stage not in STAGES:
+                raise ValueError(f"Unknown preprocessing stage '{stage}', one of: {', '.join(STAGES)}")
+        self.stages = tuple(stages)
+        self.band = tuple(band)
+        self.order = order
+        self.smooth_window = smooth_window
+        self.resample_rate = resample_rate
+
+    @staticmethod
+    def from_config(section):
+        stages = [stage.strip() for stage in section.get("preprocessing", "bandpass, smooth").split(",")]
+        band = [float(value) for value in section.get("bandpass", "0.6, 3.6").split(",")]
+        return Preprocessor([stage for stage in stages if stage != ""], band,
+                            section.getint("filter_order", 3),
+                            section.getint("smooth_window", 15),
+                            section.getfloat("resample_rate", 0))
+
+    def bandpass(self, data, sample_rate):
+        sos = design_bandpass(sample_rate, self.band[0], self.band[1], self.order)
+        # The padding of filtfilt with the (b, a) form of the filter, as in hp.filter_signal
+        return sosfiltfilt(sos, data, axis=-1, padlen=3 * (2 * self.order + 1)), sample_rate
+
+    def smooth(self, data, sample_rate):
+        window = self.smooth_window
+        if window % 2 == 0:
+            window += 1
+        return savgol_filter(data, window_length=window, polyorder=3, axis=-1), sample_rate
+
+    def resample(self, data, sample_rate):
+        if not self.resample_rate:
+            return data, sample_rate
+        length = int(round(data.shape[-1] * self.resample_rate / sample_rate))
+        return resample(data, length, axis=-1), sample_rate * length / data.shape[-1]
+
+    def detrend(self, data, sample_rate):
+        return detrend(data, axis=-1, type="linear"), sample_rate
+
+    def run(self, data, sample_rate):
+        for stage in self.stages:
+            data, sample_rate = getattr(self, stage)(data, sample_rate)
+        return data, sample_rate
+
+    def apply(self, signal, sample_rate):
+        """Returns the preprocessed signal and its sample rate"""
+        return self.run(np.asarray(signal, dtype=np.float64), sample_rate)
+
+    def apply_batch(self, signals, sample_rates):
+        """Returns the preprocessed signals and their sample rates, or None for those that failed
+
+        The signals are grouped by length and sample rate, and each group is processed as one 2D array."""
+        groups = {}
+        for i, (signal, sample_rate) in enumerate(zip(signals, sample_rates)):
+            groups.setdefault((len(signal), sample_rate), []).append(i)
+
+        results = [None] * len(signals)
+        for (length, sample_rate), positions in groups.items():
+            try:
+                data = np.vstack([np.asarray(signals[i], dtype=np.float64) for i in positions])
+                data, new_rate = self.run(data, sample_rate)
+            except Exception as e:
+                # Left to be preprocessed one by one, to fail with their own error
+                logger.debug("Preprocessing of %d signals failed: %s", len(positions), e)
+                continue
+            for row, i in enumerate(positions):
+                results[i] = data[row], new_rate
+        return results
+
+
+@lru_cache(maxsize=1)
+def get_preprocessor():
+    """The preprocessor configured in the DEFAULT section"""
+    return Preprocessor.from_config(config["DEFAULT"])
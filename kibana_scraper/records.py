@@ -1,4 +1,6 @@
-import json
+from . import decoding
+from .measure_cache import MeasureCache
+from .measure_engine import MeasureEngine, get_failure, run_model
 
 import logging
 logger = logging.getLogger(__name__)
@@ -62,56 +64,187 @@ def parse_diabetic(diabetic):
     return 1 if diabetic else 0
 
 
+def compile_path(key):
+    """Compiles a dotted key into a function finding it in the data, same as get(data, key, default)"""
+    steps = tuple((part, int(part) if part.isdigit() else None) for part in key.split("."))
+    last = len(steps) - 1
+
+    def accessor(data, default=None):
+        node = data
+        for i, (name, index) in enumerate(steps):
+            if type(node) is dict:
+                node = node.get(name, default if i == last else None)
+            elif type(node) is list and index is not None:
+                if len(node) > index:
+                    node = node[index]
+                else:
+                    return default
+            else:
+                return default
+
+            if node is None and i != last:
+                return default
+        return node
+
+    return accessor
+
+
+def parse_user_key(user_key):
+    return "" if user_key is None else str(user_key).upper()
+
+
+class Field:
+    """A record field, read from the given path of the document and converted with the transform"""
+    __slots__ = ("name", "path", "transform", "default", "accessor")
+
+    def __init__(self, name, path=None, transform=None, default=None):
+        self.name = name
+        self.path = path
+        self.transform = transform
+        self.default = default
+        self.accessor = None if path is None else compile_path(path)
+
+    def extract(self, data):
+        value = self.default if self.accessor is None else self.accessor(data, self.default)
+        return value if self.transform is None else self.transform(value)
+
+    def extract_column(self, documents):
+        """Returns the values of the field in each of the documents"""
+        if self.accessor is None:
+            values = [self.default] * len(documents)
+        else:
+            accessor, default = self.accessor, self.default
+            values = [accessor(data, default) for data in documents]
+        return values if self.transform is None else [self.transform(value) for value in values]
+
+
+COMMON_FIELDS = (
+    Field("User ID", "_id"),
+    Field("Age", "_source.profile.age"),
+    Field("Height", "_source.profile.height"),
+    Field("Weight", "_source.profile.weight"),
+    Field("Waist", "_source.profile.waist"),
+    Field("Status", "_source.status"),
+    Field("Sex", "_source.profile.sex", parse_sex),
+    Field("Diabetes Type", "_source.profile.diabeticType"),
+    Field("Ethnicity", "_source.profile.enhnicity"),
+    Field("HbAc1", "_source.profile.hbA1C"),
+)
+
+MEASURE_FIELDS = ("bpm", "ibi", "sdnn", "sdsd", "rmssd", "pnn20", "pnn50", "hr_mad",
+                  "sd1", "sd2", "s", "sd1/sd2", "breathingrate", "lf", "hf", "lf/hf")
+
+
+# The reason, why the measures of the record are missing
+MEASURE_ERROR_FIELD = "Measures Error"
+
+
+def calculate_measures_many(model, times, amplitudes):
+    """Returns the measures and the MeasureFailure (one of them None) for each of the signals
+
+    The measures are looked up in the cache first, the rest is calculated by the
+    measure engine in parallel, if it is enabled, otherwise here, after the
+    models are prepared together. Raises MeasuresCancelled, if the engine lost
+    a worker while the scraper is stopping."""
+    cache = MeasureCache.get()
+    engine = MeasureEngine.get()
+    results = [None] * len(times)
+    keys = [None] * len(times)
+    pending = {}
+    instances = {}
+
+    for i, (time, amplitude) in enumerate(zip(times, amplitudes)):
+        if cache is not None:
+            keys[i] = cache.key(model, time, amplitude)
+            measures = cache.lookup(keys[i])
+            if measures is not None:
+                results[i] = measures, None
+                continue
+
+        if engine is not None:
+            pending[i] = engine.submit(model, time, amplitude)
+        else:
+            try:
+                instances[i] = model(time, amplitude)
+            except Exception as e:
+                results[i] = None, get_failure(e)
+
+    if len(instances) > 0:
+        try:
+            model.prepare_batch(list(instances.values()))
+        except Exception as e:
+            logger.warning("Preparing %d models together failed: %s", len(instances), e)
+        for i, instance in instances.items():
+            results[i] = run_model(instance)
+
+    for i, future in pending.items():
+        results[i] = future.result()
+
+    for key, (measures, failure) in zip(keys, results):
+        if failure is not None:
+            logger.warning("Measures not calculated: %s", failure)
+        elif cache is not None and measures is not None:
+            cache.store(key, model, measures)
+
+    return results
+
+
+def calculate_measures(model, time, amplitude):
+    """Returns the measures of the signal and None, or None and the MeasureFailure"""
+    return calculate_measures_many(model, [time], [amplitude])[0]
+
+
 class BaseRecord:
-    """Abstract class for records"""
+    """Abstract class for records
+
+    The subclasses declare the layout specific fields and the paths of the PPG signal.
+    The fields are compiled once per class, and evaluated once per record, the
+    measures are calculated on first access."""
+
+    __slots__ = ("data", "model", "values", "time", "amplitude", "measures", "measures_calculation_failed",
+                 "measures_failure")
+
+    layout_fields = ()
+    time_path = None
+    amplitude_path = None
 
-    getters = {}
-    measures_calculation_failed = False
-    measures = None
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.fields = COMMON_FIELDS + tuple(cls.layout_fields)
+        cls.positions = {field.name: i for i, field in enumerate(cls.fields)}
+        # Column order: common fields, measures, measure error, layout fields
+        cls.fieldnames = (tuple(field.name for field in COMMON_FIELDS) + MEASURE_FIELDS + (MEASURE_ERROR_FIELD,) +
+                          tuple(field.name for field in cls.layout_fields))
+        cls.time_accessor = staticmethod(compile_path(cls.time_path))
+        cls.amplitude_accessor = staticmethod(compile_path(cls.amplitude_path))
 
     def __init__(self, data, model):
         self.data = data
         self.model = model
-
-        self.getters["User ID"] = lambda: get(self.data, "_id")
-        self.getters["Age"] = lambda: get(self.data, "_source.profile.age", None)
-        self.getters["Height"] = lambda: get(self.data, "_source.profile.height", None)
-        self.getters["Weight"] = lambda: get(self.data, "_source.profile.weight", None)
-        self.getters["Waist"] = lambda: get(self.data, "_source.profile.waist", None)
-        self.getters["Status"] = lambda: get(self.data, "_source.status", None)
-        self.getters["Sex"] = lambda: parse_sex(get(self.data, "_source.profile.sex", None))
-        self.getters["Diabetes Type"] = lambda: get(self.data, "_source.profile.diabeticType", None)
-        self.getters["Ethnicity"] = lambda: get(self.data, "_source.profile.enhnicity", None)
-        self.getters["HbAc1"] = lambda: get(self.data, "_source.profile.hbA1C", None)
-
-        self.getters["bpm"] = lambda: get(self.get_measures(), "bpm", None)
-        self.getters["ibi"] = lambda: get(self.get_measures(), "ibi", None)
-        self.getters["sdnn"] = lambda: get(self.get_measures(), "sdnn", None)
-        self.getters["sdsd"] = lambda: get(self.get_measures(), "sdsd", None)
-        self.getters["rmssd"] = lambda: get(self.get_measures(), "rmssd", None)
-        self.getters["pnn20"] = lambda: get(self.get_measures(), "pnn20", None)
-        self.getters["pnn50"] = lambda: get(self.get_measures(), "pnn50", None)
-        self.getters["hr_mad"] = lambda: get(self.get_measures(), "hr_mad", None)
-        self.getters["sd1"] = lambda: get(self.get_measures(), "sd1", None)
-        self.getters["sd2"] = lambda: get(self.get_measures(), "sd2", None)
-        self.getters["s"] = lambda: get(self.get_measures(), "s", None)
-        self.getters["sd1/sd2"] = lambda: get(self.get_measures(), "sd1/sd2", None)
-        self.getters["breathingrate"] = lambda: get(self.get_measures(), "breathingrate", None)
-        self.getters["lf"] = lambda: get(self.get_measures(), "lf", None)
-        self.getters["hf"] = lambda: get(self.get_measures(), "hf", None)
-        self.getters["lf/hf"] = lambda: get(self.get_measures(), "lf/hf", None)
+        self.values = tuple(field.extract(data) for field in self.fields)
+        self.time = self.time_accessor(data, [])
+        self.amplitude = self.amplitude_accessor(data, [])
+        self.measures = None
+        self.measures_calculation_failed = False
+        self.measures_failure = None
 
     def __getitem__(self, key):
-        if key in self.getters:
-            return self.getters[key]()
+        position = self.positions.get(key, None)
+        if position is not None:
+            return self.values[position]
+        elif key in MEASURE_FIELDS:
+            return get(self.get_measures(), key, None)
+        elif key == MEASURE_ERROR_FIELD:
+            self.get_measures()
+            return None if self.measures_failure is None else str(self.measures_failure)
         else:
             raise RuntimeError(f"No getter defined for key: {key}")
 
     def __contains__(self, key):
-        return key in self.getters
+        return key in self.positions or key in MEASURE_FIELDS or key == MEASURE_ERROR_FIELD
 
     def keys(self):
-        return self.getters.keys()
+        return self.fieldnames
 
     def get_measures(self):
         if self.measures is not None:
@@ -124,63 +257,80 @@ class BaseRecord:
                 return self.measures
 
     def calculate_measures(self):
-        time = self.data["_ppg"]["time"]
-        amplitude = self.data["_ppg"]["amplitude"]
+        self.measures, self.measures_failure = calculate_measures(self.model, self.time, self.amplitude)
+        self.measures_calculation_failed = self.measures is None
 
-        try:
-            model = self.model(time, amplitude)
-            working_data, self.measures = model.get_measures()
-        except Exception as e:
-            logger.warn(str(e))
-            self.measures_calculation_failed = True
 
+class RecordBatch:
+    """Records of many documents, as a list of values for each field
 
-class ResearchV2Record(BaseRecord):
-    def __init__(self, data, model):
-        super().__init__(data, model)
-        self.getters["User Key"] = lambda: get(self.data, "_source.userkey", "").upper()
-        self.getters["Trial Name"] = lambda: None
-        self.getters["Diabetic"] = lambda: parse_diabetic(get(self.data, "_source.profile.diabetesDiagnosis", None))
-        self.getters["IsSmoker"] = lambda: parse_is_smoker(get(self.data, "_source.profile.smokingStatus", None))
-        self.getters["DeviceModel"] = lambda: get(self.data, "_source.device.model", None)
-        self.getters["DeviceMake"] = lambda: get(self.data, "_source.device.make", None)
-        self.getters["Timestamp"] = lambda: get(self.data, "fields.timestamp.0", None)
+    The measure columns are empty until calculate_measures is called."""
 
-        self.data["_ppg"] = {}
-        self.data["_ppg"]["time"] = get(self.data, "_source.data.ppg.x", [])
-        self.data["_ppg"]["amplitude"] = get(self.data, "_source.data.ppg.y", [])
+    def __init__(self, model, fieldnames, columns, time, amplitude):
+        self.model = model
+        self.fieldnames = fieldnames
+        self.columns = columns
+        self.time = time
+        self.amplitude = amplitude
 
+    def __len__(self):
+        return len(self.time)
 
-class RndHistoricalRecord(BaseRecord):
-    def __init__(self, data, model):
-        super().__init__(data, model)
-        self.getters["User Key"] = lambda: get(self.data, "_source.userkey", "").upper()
-        self.getters["Trial Name"] = lambda: get(self.data, "_source.tags.0", None)
-        self.getters["Diabetic"] = lambda: parse_diabetic(get(self.data, "_source.profile.diabetic", None))
-        self.getters["IsSmoker"] = lambda: parse_is_smoker(get(self.data, "_source.profile.smoker", None))
-        self.getters["DeviceModel"] = lambda: get(self.data, "_source.device.model", None)
-        self.getters["DeviceMake"] = lambda: get(self.data, "_source.device.make", None)
-        self.getters["Timestamp"] = lambda: get(self.data, "fields.timestamp.0", None)
+    def calculate_measures(self):
+        """Fills in the measure columns, and the reasons of the failures"""
+        results = calculate_measures_many(self.model, self.time, self.amplitude)
+        for name in MEASURE_FIELDS:
+            self.columns[name] = [get(measures, name, None) for measures, failure in results]
+        self.columns[MEASURE_ERROR_FIELD] = [None if failure is None else str(failure) for measures, failure in results]
 
-        self.data["_ppg"] = {}
-        self.data["_ppg"]["time"] = get(self.data, "_source.data.ppg.x", [])
-        self.data["_ppg"]["amplitude"] = get(self.data, "_source.data.ppg.y", [])
+    def rows(self):
+        """Returns the values of the records, in the order of the fieldnames"""
+        return list(zip(*(self.columns[name] for name in self.fieldnames)))
 
 
-class SignalsRecord(BaseRecord):
-    def __init__(self, data, model):
-        super().__init__(data, model)
-        self.getters["User Key"] = lambda: get(self.data, "_source.accountId", "").upper()
-        self.getters["Trial Name"] = lambda: None
-        self.getters["Diabetic"] = lambda: parse_diabetic(get(self.data, "_source.profile.diabetesDiagnosis", None))
-        self.getters["IsSmoker"] = lambda: parse_is_smoker(get(self.data, "_source.profile.smokingStatus", None))
-        self.getters["DeviceModel"] = lambda: get(self.data, "_source.source.model", None)
-        self.getters["DeviceMake"] = lambda: get(self.data, "_source.source.make", None)
-        self.getters["Timestamp"] = lambda: get(self.data, "fields.createdOn.0", None)
+class ResearchV2Record(BaseRecord):
+    __slots__ = ()
+    layout_fields = (
+        Field("User Key", "_source.userkey", parse_user_key, ""),
+        Field("Trial Name"),
+        Field("Diabetic", "_source.profile.diabetesDiagnosis", parse_diabetic),
+        Field("IsSmoker", "_source.profile.smokingStatus", parse_is_smoker),
+        Field("DeviceModel", "_source.device.model"),
+        Field("DeviceMake", "_source.device.make"),
+        Field("Timestamp", "fields.timestamp.0"),
+    )
+    time_path = "_source.data.ppg.x"
+    amplitude_path = "_source.data.ppg.y"
 
-        self.data["_ppg"] = {}
-        self.data["_ppg"]["time"] = get(self.data, "_source.channels.0.time", [])
-        self.data["_ppg"]["amplitude"] = get(self.data, "_source.channels.0.amplitude", [])
+
+class RndHistoricalRecord(BaseRecord):
+    __slots__ = ()
+    layout_fields = (
+        Field("User Key", "_source.userkey", parse_user_key, ""),
+        Field("Trial Name", "_source.tags.0"),
+        Field("Diabetic", "_source.profile.diabetic", parse_diabetic),
+        Field("IsSmoker", "_source.profile.smoker", parse_is_smoker),
+        Field("DeviceModel", "_source.device.model"),
+        Field("DeviceMake", "_source.device.make"),
+        Field("Timestamp", "fields.timestamp.0"),
+    )
+    time_path = "_source.data.ppg.x"
+    amplitude_path = "_source.data.ppg.y"
+
+
+class SignalsRecord(BaseRecord):
+    __slots__ = ()
+    layout_fields = (
+        Field("User Key", "_source.accountId", parse_user_key, ""),
+        Field("Trial Name"),
+        Field("Diabetic", "_source.profile.diabetesDiagnosis", parse_diabetic),
+        Field("IsSmoker", "_source.profile.smokingStatus", parse_is_smoker),
+        Field("DeviceModel", "_source.source.model"),
+        Field("DeviceMake", "_source.source.make"),
+        Field("Timestamp", "fields.createdOn.0"),
+    )
+    time_path = "_source.channels.0.time"
+    amplitude_path = "_source.channels.0.amplitude"
 
 
 class RecordFactory:
@@ -197,17 +347,52 @@ class RecordFactory:
             raise ValueError("_index value not supported: " + str(index))
 
     @staticmethod
-    def load(model, *args, **kwargs):
-        """Loads the data from a file pointer and returns a Record instance. All parameters passed to json.load"""
-        data = json.load(*args, **kwargs)
-        cls = RecordFactory.get_class(data)
-
-        return cls(data, model)
+    def load(model, fp):
+        """Loads the data from a file pointer and returns a Record instance. The signals are decoded as NumPy arrays"""
+        return RecordFactory.loads(model, fp.read())
 
     @staticmethod
-    def loads(model, *args, **kwargs):
-        """Loads the data from a string and returns a Record instance. All parameters passed to json.loads"""
-        data = json.loads(*args, **kwargs)
+    def loads(model, text):
+        """Loads the data from a string and returns a Record instance. The signals are decoded as NumPy arrays"""
+        data = decoding.loads(text)
         cls = RecordFactory.get_class(data)
 
         return cls(data, model)
+
+    @staticmethod
+    def load_batch(model, documents):
+        """Loads many documents from strings (or decoded already) at once, and returns a RecordBatch
+
+        The fields are extracted column by column, with the accessors compiled for the record classes."""
+        data = [decoding.loads(document) if isinstance(document, str) else document for document in documents]
+        classes = [RecordFactory.get_class(item) for item in data]
+        groups = {}
+        for i, cls in enumerate(classes):
+            groups.setdefault(cls, []).append(i)
+
+        fieldnames = []
+        for cls in groups:
+            fieldnames.extend(name for name in cls.fieldnames if name not in fieldnames)
+        columns = {name: [None] * len(data) for name in fieldnames}
+        time = [None] * len(data)
+        amplitude = [None] * len(data)
+
+        for cls, positions in groups.items():
+            group = data if len(groups) == 1 else [data[i] for i in positions]
+            if len(groups) == 1:
+                # The whole page is of the same index, the columns are used as they are
+                for field in cls.fields:
+                    columns[field.name] = field.extract_column(group)
+                time = [cls.time_accessor(item, []) for item in group]
+                amplitude = [cls.amplitude_accessor(item, []) for item in group]
+                continue
+
+            for field in cls.fields:
+                column = columns[field.name]
+                for i, value in zip(positions, field.extract_column(group)):
+                    column[i] = value
+            for i, item in zip(positions, group):
+                time[i] = cls.time_accessor(item, [])
+                amplitude[i] = cls.amplitude_accessor(item, [])
+
+        return RecordBatch(model, fieldnames, columns, time, amplitude)
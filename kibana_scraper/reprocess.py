@@ -0,0 +1,318 @@
+"""
+kibana_scraper/reprocess.py
+
+Recalculates the records of the sections from the cached JSON documents
+
+The documents kept in the archive of the section (with save_json_files) are
+parsed, and their measures calculated with the chosen model, by a pool of
+processes, into a new generation of the section's CSV file. Records without a
+cached document are carried over from the current CSV files. The documents
+still kept one file for each are migrated into the archive first.
+
+The new generation is written in cache/<section>/reprocess, and it replaces
+the CSV files of the section only when it is complete, the replaced files are
+moved to cache/<section>/superseded/<generation>. An interrupted run is
+resumed, skipping the documents already in the partial file. A batch which
+fails (e.g. its worker crashed) is processed again one document at a time,
+the documents failing alone are carried over.
+
+Usage:
+    python -m kibana_scraper reprocess [--model hp|stl] [--workers N] [section ...]
+"""
+import os
+import csv
+import json
+import shutil
+import multiprocessing
+from datetime import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from .config import config
+from .records import RecordFactory
+from .models import HPModel, STLNormalizationModel
+from .signals import signals
+from .archive import JsonArchive, migrate
+from .pipeline import ignore_interrupt
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Times a document failing alone is processed again, after a worker crash
+MAX_ATTEMPTS = 3
+
+MODELS = {
+    "hp": HPModel,
+    "stl": STLNormalizationModel,
+}
+
+
+def process_documents(model, user_ids, documents):
+    """Runs in the worker processes. Returns the header and the rows of the records of the documents"""
+    try:
+        batches = [RecordFactory.load_batch(model, documents)]
+    except Exception:
+        # A bad document fails the batch, so the documents are loaded one by one
+        batches = []
+        for document, user_id in zip(documents, user_ids):
+            try:
+                batches.append(RecordFactory.load_batch(model, [document]))
+            except Exception as e:
+                logger.error("Skipping %s: %s", user_id, e)
+
+    header = None
+    rows = []
+    for batch in batches:
+        batch.calculate_measures()
+        header = list(batch.fieldnames)
+        rows.extend(batch.rows())
+    return header, rows
+
+
+def truncate_partial_line(path):
+    """Drops the last line of the file, if it was not completely written"""
+    with open(path, "rb+") as f:
+        data = f.read()
+        if len(data) > 0 and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def read_user_ids(path):
+    with open(path, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return None, set()
+        user_id_index = header.index("User ID")
+        return header, {row[user_id_index] for row in reader if len(row) > user_id_index}
+
+
+class Reprocessing:
+    def __init__(self, section, model_name, workers, batch_size):
+        self.section = section
+        self.model_name = model_name
+        self.model = MODELS[model_name]
+        self.workers = workers
+        self.batch_size = batch_size
+        self.folder = os.path.join("cache", section)
+        self.json_cache = os.path.join(self.folder, "json")
+        self.csv_cache = os.path.join(self.folder, "csv")
+        self.work_folder = os.path.join(self.folder, "reprocess")
+        self.state_path = os.path.join(self.work_folder, "state.json")
+
+    def load_state(self):
+        try:
+            with open(self.state_path, "rt") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_state(self, state):
+        os.makedirs(self.work_folder, exist_ok=True)
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "wt") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.state_path)
+
+    def run(self):
+        """Writes and swaps in a new generation, returns False if it was interrupted"""
+        state = self.load_state()
+        if state is not None and state["model"] != self.model_name:
+            logger.warning("Discarding the interrupted reprocessing of %s with model %s",
+                           self.section, state["model"])
+            shutil.rmtree(self.work_folder)
+            state = None
+
+        if state is None:
+            state = {"generation": datetime.now().strftime("%Y%m%d-%H%M%S"), "model": self.model_name,
+                     "complete": False}
+            self.save_state(state)
+        else:
+            logger.info("Resuming the reprocessing of %s, generation %s", self.section, state["generation"])
+
+        generation = state["generation"]
+        partial_path = os.path.join(self.work_folder, f"{self.section}-{generation}.csv.partial")
+        output_path = os.path.join(self.work_folder, f"{self.section}-{generation}.csv")
+
+        if not state["complete"]:
+            if not self.write_generation(partial_path):
+                return False
+            self.carry_over(partial_path)
+            os.replace(partial_path, output_path)
+            state["complete"] = True
+            self.save_state(state)
+
+        self.swap(generation, output_path)
+        shutil.rmtree(self.work_folder)
+        return True
+
+    def get_chunks(self, archive, done):
+        """Yields the User IDs and the documents of the archive, batch_size at a time, except the done ones"""
+        user_ids, documents = [], []
+        for user_id, document in archive:
+            if user_id in done:
+                continue
+            user_ids.append(user_id)
+            documents.append(document)
+            if len(user_ids) >= self.batch_size:
+                yield user_ids, documents
+                user_ids, documents = [], []
+        if len(user_ids) > 0:
+            yield user_ids, documents
+
+    def start_executor(self):
+        # Forked workers would inherit the threads of the measure engine and the STL pool
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=ignore_interrupt)
+
+    def submit(self, chunk):
+        """Submits a chunk to the pool, starting a new one if a crashed worker broke it"""
+        try:
+            return self.executor.submit(process_documents, self.model, *chunk)
+        except BrokenProcessPool:
+            logger.error("A reprocessing worker crashed, starting a new pool")
+            self.executor.shutdown(wait=False)
+            self.start_executor()
+            return self.executor.submit(process_documents, self.model, *chunk)
+
+    def write_generation(self, path):
+        if any(filename.endswith(".json") for filename in os.listdir(self.json_cache)):
+            migrate(self.section)
+        archive = JsonArchive.get(self.section)
+
+        header = None
+        done = set()
+        if os.path.exists(path):
+            truncate_partial_line(path)
+            header, done = read_user_ids(path)
+            logger.info("%s: %d documents done, %d left", self.section, len(done), len(archive) - len(done))
+        else:
+            logger.info("%s: %d documents to reprocess with %s", self.section, len(archive), self.model.__name__)
+
+        chunks = self.get_chunks(archive, done)
+        processed = 0
+        self.start_executor()
+        try:
+            with open(path, "a", newline="") as output:
+                writer = csv.writer(output)
+                # The chunks of the futures, and the documents of the failed chunks, to be processed one at a time
+                pending = {}
+                retries = []
+                # A document is also lost with the pool broken by another one, so it is tried a few times alone
+                attempts = Counter()
+                chunk = next(chunks, None)
+                while (chunk is not None or len(retries) > 0 or len(pending) > 0) and not signals.stop:
+                    # At most two chunks per worker are in flight
+                    while (chunk is not None or len(retries) > 0) and len(pending) < 2 * self.workers:
+                        if len(retries) > 0:
+                            task = retries.pop()
+                        else:
+                            task, chunk = chunk, next(chunks, None)
+                        pending[self.submit(task)] = task
+
+                    completed, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        user_ids, documents = pending.pop(future)
+                        try:
+                            chunk_header, rows = future.result()
+                        except Exception as e:
+                            if signals.stop:
+                                continue
+                            if len(user_ids) > 1:
+                                logger.warning("%d documents failed together, retrying one at a time: %s",
+                                               len(user_ids), e)
+                                retries.extend(([user_id], [document])
+                                               for user_id, document in zip(user_ids, documents))
+                            elif isinstance(e, BrokenProcessPool) and attempts[user_ids[0]] < MAX_ATTEMPTS:
+                                attempts[user_ids[0]] += 1
+                                retries.append((user_ids, documents))
+                            else:
+                                logger.error("Skipping %s, its record is carried over: %s", user_ids[0], e)
+                            continue
+                        if chunk_header is None:
+                            continue
+                        if header is None:
+                            header = chunk_header
+                            writer.writerow(header)
+                        elif chunk_header != header:
+                            rows = [dict(zip(chunk_header, row)) for row in rows]
+                            rows = [[row.get(name, None) for name in header] for row in rows]
+                        writer.writerows(rows)
+                        processed += len(rows)
+                    output.flush()
+                    os.fsync(output.fileno())
+                    if len(completed) > 0:
+                        logger.info("%s: %d documents reprocessed", self.section, processed)
+
+                if signals.stop:
+                    for future in pending:
+                        future.cancel()
+                    logger.info("Reprocessing of %s interrupted, it will be resumed by the next run", self.section)
+                    return False
+        finally:
+            self.executor.shutdown(wait=True)
+        return True
+
+    def carry_over(self, path):
+        """Appends the records of the current CSV files, which have no cached document"""
+        header, done = read_user_ids(path)
+        carried = 0
+        with open(path, "a", newline="") as output:
+            writer = csv.writer(output)
+            for filename in sorted(os.listdir(self.csv_cache)):
+                with open(os.path.join(self.csv_cache, filename), "r", newline="") as f:
+                    reader = csv.DictReader(f)
+                    if reader.fieldnames is None:
+                        continue
+                    if header is None:
+                        header = reader.fieldnames
+                        writer.writerow(header)
+                    for row in reader:
+                        if row["User ID"] in done:
+                            continue
+                        done.add(row["User ID"])
+                        writer.writerow([row.get(name, None) for name in header])
+                        carried += 1
+
+        if carried > 0:
+            logger.info("%s: %d records without a cached document carried over", self.section, carried)
+
+    def swap(self, generation, output_path):
+        """Moves the current CSV files out of the way, and the new generation in their place"""
+        if not os.path.exists(output_path):
+            # Swapped in already, by the interrupted run
+            return
+
+        superseded = os.path.join(self.folder, "superseded", generation)
+        os.makedirs(superseded, exist_ok=True)
+        os.makedirs(self.csv_cache, exist_ok=True)
+        for filename in os.listdir(self.csv_cache):
+            os.replace(os.path.join(self.csv_cache, filename), os.path.join(superseded, filename))
+        os.replace(output_path, os.path.join(self.csv_cache, os.path.basename(output_path)))
+        logger.info("%s: generation %s is in place, the previous files are in %s", self.section, generation, superseded)
+
+
+def reprocess(sections=None, model_name="hp", workers=None):
+    """Reprocesses the given (or all the enabled) sections, returns the completed ones"""
+    if model_name not in MODELS:
+        raise ValueError(f"Unknown model '{model_name}', one of: {', '.join(MODELS)}")
+    workers = workers or os.cpu_count()
+    batch_size = config["DEFAULT"].getint("batch_size", 100)
+
+    if not sections:
+        sections = [section for section in config.sections() if config[section].getboolean("enabled", True)]
+
+    done = set()
+    for section in sections:
+        if signals.stop:
+            break
+        if not os.path.isdir(os.path.join("cache", section, "json")):
+            logger.warning("No cached JSON documents for %s, skipping", section)
+            continue
+
+        if Reprocessing(section, model_name, workers, batch_size).run():
+            done.add(section)
+    return done
@@ -9,6 +9,8 @@ Robot.go(target)
 """
 import os
 import json
+import shutil
+import tempfile
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.common.keys import Keys
@@ -19,7 +21,6 @@ from selenium.webdriver.firefox.options import Options
 from selenium.common.exceptions import ElementClickInterceptedException
 from selenium.common.exceptions import ElementNotInteractableException
 from selenium.common.exceptions import TimeoutException
-from time import sleep
 from datetime import datetime, timezone
 from urllib.parse import urlparse
 
@@ -28,29 +29,124 @@ logger = logging.getLogger(__name__)
 
 from .config import config
 from .signals import signals
+from .waiting import Waiter
+from .locators import LocatorCache
+from .cursors import Cursor
 
 SHORT_WAIT = config["DEFAULT"].getint("short_wait", 5)
 MEDIUM_WAIT = config["DEFAULT"].getint("medium_wait", 30)
 LONG_WAIT = config["DEFAULT"].getint("long_wait", 60)
 
+# Marionette port of the first browser, the other workers use the following ports
+MARIONETTE_PORT = 2828
+
+LEAN_BROWSER = config["DEFAULT"].getboolean("lean_browser", False)
+
+# Firefox preferences of the lean mode, skipping the resources the robot doesn't need
+LEAN_PREFERENCES = {
+    # Don't load images
+    "permissions.default.image": 2,
+    # Don't download web fonts, use the system fonts
+    "gfx.downloadable_fonts.enabled": False,
+    "browser.display.use_document_fonts": 0,
+    # Reduce animations
+    "ui.prefersReducedMotion": 1,
+    "toolkit.cosmeticAnimations.enabled": False,
+    # Less memory per browser
+    "webgl.disabled": True,
+    "dom.ipc.processCount": 1,
+    "browser.sessionhistory.max_entries": 2,
+    "browser.cache.memory.capacity": 16384,
+}
+
+# Hides the Discover histogram (a hidden chart is not rendered) and disables the
+# CSS animations and transitions. Injected after each navigation in lean mode.
+LEAN_STYLE_SCRIPT = """
+if (document.getElementById("kibana-scraper-lean") === null) {
+    var style = document.createElement("style");
+    style.id = "kibana-scraper-lean";
+    style.textContent = ".dscTimechart, .dscHistogram, discover-histogram { display: none !important; } " +
+        "*, *::before, *::after { animation: none !important; transition: none !important; }";
+    document.head.appendChild(style);
+}
+"""
+
+# Collects the hits of every loaded row in one go, from the scope of the
+# angular doc-table directive. Returns null, if the hit data is not reachable.
+BULK_EXTRACTION_SCRIPT = """
+var tbody = arguments[0];
+var angular = window.angular;
+if (!angular) {
+    return null;
+}
+
+var toJson = function (hit) {
+    // angular.toJson drops the $$ prefixed bookkeeping fields of the doc-table
+    return angular.toJson(hit);
+};
+
+var rows = tbody.children;
+var result = [];
+for (var i = 0; i < rows.length; i += 2) {
+    var row = rows[i];
+    var scope = angular.element(row).scope();
+    if (!scope || !scope.row) {
+        return null;
+    }
+
+    var timestamp = row.querySelector(':scope > td:nth-child(2) > span');
+    result.push({
+        user_id: scope.row._id,
+        timestamp: timestamp ? timestamp.innerText : null,
+        document: toJson(scope.row)
+    });
+}
+return result;
+"""
+
+# The _id of the hit of a summary row, from the scope of the doc-table directive, or null
+HIT_ID_SCRIPT = """
+var angular = window.angular;
+var scope = angular ? angular.element(arguments[0]).scope() : null;
+return scope && scope.row ? scope.row._id : null;
+"""
+
 class Robot:
-    def __init__(self, username, password):
+    def __init__(self, username, password, worker=0):
         firefox_profile = config["DEFAULT"].get("firefox_profile", None)
         self.username = username
         self.password = password
+        self.profile_copy = None
         
         options = Options()
         service_args = []
+
+        if LEAN_BROWSER:
+            options.headless = True
+            for name, value in LEAN_PREFERENCES.items():
+                options.set_preference(name, value)
         
         # use profile only if specified
         if firefox_profile is not None:
+            # A profile can only be used by one browser at a time,
+            # so every worker but the first one runs on a copy of it
+            if worker > 0:
+                self.profile_copy = tempfile.mkdtemp(prefix="kibana_scraper_profile_")
+                firefox_profile = os.path.join(self.profile_copy, "profile")
+                shutil.copytree(config["DEFAULT"]["firefox_profile"], firefox_profile,
+                                ignore=shutil.ignore_patterns("lock", ".parentlock", "parent.lock"))
+
             options.add_argument("-profile")
             options.add_argument(firefox_profile)
             # explicit marionette port, so we can connect to the instance
             service_args.append("--marionette-port")
-            service_args.append("2828")
+            service_args.append(str(MARIONETTE_PORT + worker))
             
         self.driver = webdriver.Firefox(options=options, service_args=service_args)
+        self.waiter = Waiter(self.driver)
+        self.locators = LocatorCache()
+        self.cursor = None
+        self.page_tail = None
     
     def __enter__(self):
         return self
@@ -58,6 +154,8 @@ class Robot:
     def __exit__(self, exc_type, exc_value, traceback):
         if config["DEFAULT"].getboolean("auto_close_browser", True):
             self.driver.quit()
+            if self.profile_copy is not None:
+                shutil.rmtree(self.profile_copy, ignore_errors=True)
      
     # Page layout:
     #
@@ -80,20 +178,29 @@ class Robot:
     
     # Functions to access relevant nodes on the page
     
+    # The containers of the table are cached until the next navigation,
+    # as they are looked up for every row
+    
     def get_discover_app(self):
-        wait = WebDriverWait(self.driver, LONG_WAIT)
-        return wait.until(EC.presence_of_element_located((By.XPATH, "//discover-app")))
+        def resolve():
+            wait = WebDriverWait(self.driver, LONG_WAIT)
+            return wait.until(EC.presence_of_element_located((By.XPATH, "//discover-app")))
+        return self.locators.get("discover_app", resolve)
         
     def get_dsc_table(self):
-        wait = WebDriverWait(self.get_discover_app(), LONG_WAIT)
-        return wait.until(EC.presence_of_element_located((By.XPATH, "./main//section[contains(@class, 'dscTable')]")))
+        def resolve():
+            wait = WebDriverWait(self.get_discover_app(), LONG_WAIT)
+            return wait.until(EC.presence_of_element_located((By.XPATH, "./main//section[contains(@class, 'dscTable')]")))
+        return self.locators.get("dsc_table", resolve)
             
     def get_doc_table(self):
-        try:
-            wait = WebDriverWait(self.get_dsc_table(), LONG_WAIT)
-            return wait.until(EC.presence_of_element_located((By.XPATH, "./doc-table//table/tbody")))
-        except:
-            return None
+        def resolve():
+            try:
+                wait = WebDriverWait(self.get_dsc_table(), LONG_WAIT)
+                return wait.until(EC.presence_of_element_located((By.XPATH, "./doc-table//table/tbody")))
+            except:
+                return None
+        return self.locators.get("doc_table", resolve)
         
     def get_footer(self):
         try:
@@ -127,8 +234,10 @@ class Robot:
         return wait.until(EC.presence_of_element_located((By.XPATH, ".//input[@data-test-subj='superDatePickerAbsoluteDateInput']")))
             
     def get_infinite_scroller(self):
-        wait = WebDriverWait(self.get_dsc_table(), SHORT_WAIT)
-        return wait.until(EC.presence_of_element_located((By.XPATH, './doc-table//kbn-infinite-scroll')))
+        def resolve():
+            wait = WebDriverWait(self.get_dsc_table(), SHORT_WAIT)
+            return wait.until(EC.presence_of_element_located((By.XPATH, './doc-table//kbn-infinite-scroll')))
+        return self.locators.get("infinite_scroller", resolve)
 
     def get_user_id(self, row):
         """Returns User ID from a summary_row"""
@@ -138,6 +247,11 @@ class Robot:
             # Element not found
             return None
     
+    def get_hit_id(self, row):
+        """Returns the _id of the hit of a summary_row, or the id shown in the summary, or None"""
+        user_id = self.driver.execute_script(HIT_ID_SCRIPT, row)
+        return user_id if user_id is not None else self.get_user_id(row)
+
     def get_timestamp(self, row):
         wait = WebDriverWait(row, SHORT_WAIT)
         return wait.until(EC.presence_of_element_located((By.XPATH, "./td[2]/span[1]"))).text
@@ -150,6 +264,13 @@ class Robot:
             return None
         
     
+    def get_hits_counter(self):
+        try:
+            wait = WebDriverWait(self.get_discover_app(), SHORT_WAIT)
+            return wait.until(EC.presence_of_element_located((By.XPATH, ".//*[@data-test-subj='discoverQueryHits']")))
+        except:
+            return None
+    
     def get_login_form(self):
         wait = WebDriverWait(self.driver, LONG_WAIT)
         return wait.until(EC.presence_of_element_located((By.XPATH, ".//div[contains(@class, 'login-form')]//form")))
@@ -203,7 +324,8 @@ class Robot:
             element.click()
         except:
         #except ElementClickInterceptedException:
-            sleep(1)
+            # Let pending requests and renders settle before forcing the click
+            self.waiter.wait_for_idle(SHORT_WAIT)
             self.driver.execute_script("arguments[0].click();", element)
         
     def extract_document(self, row):
@@ -227,24 +349,25 @@ class Robot:
 
         return text
 
-    def store_record(self, target, record, document, user_id):
-        """Takes a string, containing a json document, and sores it using the given target"""
-        
-        target.store(record)
-        if config["DEFAULT"].getboolean("save_json_files", False):
-            target.store_json(document, user_id)
-
     def process_table(self, target):
-        table = self.get_doc_table()
-
         logger.info("Waiting for data to be loaded on the page")
         self.load_all_elements()
+        self.page_tail = None
         
         if config["DEFAULT"].getboolean("fast_scan", False):
             logger.info("fast_scan mode")
             return
+
+        if target.config.getboolean("bulk_extraction", False):
+            rows = self.extract_page()
+            if rows is not None:
+                self.process_batch(target, rows)
+                return
+            logger.info("Bulk extraction is not available on this page, extracting row by row")
                 
-        for index in range(1, self.count_rows()+1, 2):
+        row_count = self.count_rows()
+        overlapping = 0
+        for index in range(1, row_count+1, 2):
             if signals.stop:
                 return
 
@@ -259,6 +382,10 @@ class Robot:
             index += 2
             
             user_id = self.get_user_id(row)
+
+            if self.is_processed_at_boundary(user_id):
+                overlapping += 1
+                continue
             
             if user_id is None:
                 # Id is not available in the summary
@@ -269,29 +396,68 @@ class Robot:
                 if target.seen(user_id):
                         logger.info("Already in cache: %s", user_id)
                         continue
+
+                # Already parsed, store it right away
+                target.store_document(record, document, user_id)
+                logger.info("Stored: %s", user_id)
             else:
                 if target.seen(user_id):
                         logger.info("Already in cache: %s", user_id)
                         continue
             
                 document = self.extract_document(row)
-                record = target.parse(document)
-            
-            self.store_record(target, record, document, user_id)
-            logger.info("Stored: %s", user_id)
+                target.process(document, user_id)
+
+        self.log_overlap(row_count // 2, overlapping)
+
+    def is_processed_at_boundary(self, user_id):
+        """True, if the row was processed on the previous page, at the timestamp of the cursor"""
+        return self.cursor is not None and user_id in self.cursor.boundary_ids
+
+    def log_overlap(self, row_count, overlapping):
+        rate = 100 * overlapping / row_count if row_count > 0 else 0
+        logger.info("Page overlap: %d of %d rows (%.1f%%)", overlapping, row_count, rate)
+
+    def extract_page(self):
+        """Extracts the user id, timestamp and JSON document of every loaded row with a single script"""
+        return self.driver.execute_script(BULK_EXTRACTION_SCRIPT, self.get_doc_table())
+
+    def process_batch(self, target, rows):
+        """Stores the rows returned by extract_page, without further calls to the browser"""
+        logger.info("Extracted %d documents from the page", len(rows))
+
+        if len(rows) > 0:
+            timestamp = rows[-1]["timestamp"]
+            tail_ids = [row["user_id"] for row in rows if row["timestamp"] == timestamp]
+            self.page_tail = (timestamp, tail_ids)
+
+        overlapping = 0
+        documents = []
+        user_ids = []
+        for row in rows:
+            user_id = row["user_id"]
+            if self.is_processed_at_boundary(user_id):
+                overlapping += 1
+                continue
+
+            if target.seen(user_id):
+                logger.info("Already in cache: %s", user_id)
+                continue
+
+            documents.append(row["document"])
+            user_ids.append(user_id)
+
+        if signals.stop:
+            return
+
+        target.process_batch(documents, user_ids)
+        self.log_overlap(len(rows), overlapping)
 
     def count_rows(self):
         return len(self.get_doc_table().find_elements_by_xpath("./tr"))
         
     def load_all_elements(self, timeout=SHORT_WAIT):
         """Triggers infinite scolling until all elements are loaded"""
-        def new_rows_are_loaded(row_count):
-            for i in range(timeout):
-                sleep(1)
-                if row_count != self.count_rows():
-                    return True
-            return False
-        
         while True:
             if signals.stop:
                 return
@@ -303,47 +469,104 @@ class Robot:
             self.driver.execute_script("arguments[0].scrollIntoView(true);", infinite_scroller);
             
             # If no new elements are loaded, return
-            if not new_rows_are_loaded(row_count):
+            if not self.waiter.wait_for_new_rows(self.get_doc_table(), row_count, timeout):
                 return
             
     def query_has_more_elements(self):
         """Return true if footer exists on page"""
         return self.get_footer() is not None
     
-    def get_last_displayed_elements_timestamp(self):
-        row_count = self.count_rows()
-        last_summary_row_index = row_count-1
-        last_summary_row = self.get_row_at_index(last_summary_row_index)
-        
-        timestamp = self.get_timestamp(last_summary_row)
-        
-        return timestamp
+    def get_page_tail(self):
+        """Returns the timestamp of the last displayed row, and the ids of the rows sharing that timestamp"""
+        timestamp = None
+        tail_ids = []
+
+        # Walk back the summary rows from the end of the table
+        for index in range(self.count_rows() - 1, 0, -2):
+            row = self.get_row_at_index(index)
+            row_timestamp = self.get_timestamp(row)
+            if timestamp is None:
+                timestamp = row_timestamp
+            elif row_timestamp != timestamp:
+                break
+
+            user_id = self.get_hit_id(row)
+            if user_id is None:
+                # The next page would start with the rows already read, again
+                raise RuntimeError(f"No id in a row at {timestamp}, the rows already read can't be excluded")
+            tail_ids.append(user_id)
+
+        return timestamp, tail_ids
         
-    def update_search(self, url):
+    def update_search(self, target):
         logger.info("Loading next page")
-        timestamp = self.get_last_displayed_elements_timestamp()
+        if self.page_tail is None:
+            self.page_tail = self.get_page_tail()
+        timestamp, tail_ids = self.page_tail
+
+        # The next page ends at the last timestamp, without the documents already processed there
+        previous = self.cursor or Cursor(None)
+        self.cursor = previous.advance(self.to_utc(timestamp), tail_ids)
+
+        # The page is fully processed, a restart can continue with the next one
+        target.save_cursor(self.cursor.to_dict())
+
+        url = self.build_search_url(target, self.cursor)
+        if target.config.getboolean("spa_pagination", False):
+            if self.navigate_in_app(url):
+                return
+            logger.info("In-app navigation failed, reloading the page")
         
-        self.navigate(self.build_search_url(url, timestamp))
+        self.navigate(url)
+
+    def to_utc(self, timestamp):
+        """Converts a displayed timestamp into the format of the to_time_utc option"""
+        to_time = datetime.strptime(timestamp, "%b %d, %Y @ %H:%M:%S.%f")
+        return "'" + to_time.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z'"
         
-    def build_search_url(self, original_url, timestamp=None):
+    def build_search_url(self, target, cursor=None):
         params = {}
         
-        if timestamp is None:
-            params["to_time_utc"] = config["DEFAULT"].get("to_time_utc", "now")
+        if cursor is None:
+            params["to_time_utc"] = target.to_time_utc
         else:
-            to_time = datetime.strptime(timestamp, "%b %d, %Y @ %H:%M:%S.%f")
-            params["to_time_utc"] = "'" + to_time.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z'"
+            params["to_time_utc"] = cursor.to_time_utc
         
-        params["from_time_utc"] = config["DEFAULT"].get("from_time_utc", "'2016-12-29T09:57:28.503Z'")
+        params["from_time_utc"] = target.from_time_utc
         
-        return original_url.format(**params)
+        url = target.config["url"].format(**params)
+        if cursor is not None:
+            url = cursor.apply(url)
+
+        return url
         
     def navigate(self, url):
         logger.info("Opening URL: %s", url)
+        logger.debug("Locator cache: %(hits)d hits, %(misses)d misses, %(invalidations)d invalidations",
+                     self.locators.stats())
+        self.locators.invalidate()
         self.driver.get("about:blank")
         self.driver.get(url)
+        self.apply_lean_style()
+
+    def navigate_in_app(self, url):
+        """Loads the url by changing the state of the already loaded Discover app, without reloading Kibana.
+
+        Returns False, if the app is not loaded, or did not display the new results in time"""
+        current = urlparse(self.driver.current_url)
+        parsed = urlparse(url)
+        if (current.scheme, current.netloc, current.path) != (parsed.scheme, parsed.netloc, parsed.path):
+            return False
 
-    def screenshot(self, robot):
+        logger.info("Opening URL in app: %s", url)
+        self.locators.invalidate()
+        return self.waiter.navigate_hash("#" + parsed.fragment, LONG_WAIT)
+
+    def apply_lean_style(self):
+        if LEAN_BROWSER:
+            self.driver.execute_script(LEAN_STYLE_SCRIPT)
+
+    def screenshot(self):
         screenshots_path = os.path.abspath(config["DEFAULT"].get("screenshots.path", "."))
 
         try:
@@ -362,7 +585,14 @@ class Robot:
         if url is None:
             raise ValueError("URL is not set for section: " + target.section)
         
-        self.navigate(self.build_search_url(url))
+        cursor = target.get_cursor()
+        if cursor is None:
+            self.cursor = None
+        else:
+            self.cursor = Cursor.from_dict(cursor)
+            logger.info("Resuming from: %s", self.cursor.to_time_utc)
+
+        self.navigate(self.build_search_url(target, self.cursor))
         
         if self.login_required():
             logger.info("Login required")
@@ -377,10 +607,13 @@ class Robot:
                 pass
             elif self.get_no_results_warnig() is not None:
                 logger.info("No more elements to parse")
+                target.complete()
                 return
             elif self.get_page_failed_to_load_warning() is not None:
                 logger.info("Page failed to load. Trying again.")
+                self.locators.invalidate()
                 self.driver.refresh()
+                self.apply_lean_style()
                 continue
             else:
                 raise TimeoutException("No table or warning message appeared")
@@ -393,13 +626,40 @@ class Robot:
                 return
                 
             if self.query_has_more_elements():
-                self.update_search(url)
+                self.update_search(target)
             else:
+                target.complete()
                 return
             
+    def count_hits(self, target):
+        """Returns the number of hits in the time window of the target (or shard)"""
+        self.navigate(self.build_search_url(target))
+
+        if self.login_required():
+            logger.info("Login required")
+            self.attempt_login()
+
+        hits_counter = self.get_hits_counter()
+        if hits_counter is None:
+            if self.get_no_results_warnig() is not None:
+                return 0
+            raise TimeoutException("No hit count or warning message appeared")
+
+        return int(hits_counter.text.replace(",", ""))
+
+    def login(self, url):
+        """Opens the given url, logs in if required, and returns the session cookies"""
+        self.navigate(url)
+
+        if self.login_required():
+            logger.info("Login required")
+            self.attempt_login()
+
+        return self.driver.get_cookies()
+
     def login_required(self):
         url = urlparse(self.driver.current_url)
-        print(url.path)
+        logger.debug("Current path: %s", url.path)
         
         return url.path == "/login"
         
@@ -419,7 +679,18 @@ class Robot:
         self.get_username_field().send_keys(self.username)
         self.get_password_field().send_keys(self.password)
         self.click(self.get_login_button())
-        sleep(1)
+        self.locators.invalidate()
+
+        # Either the login page is left, or an error message appears
+        try:
+            WebDriverWait(self.driver, MEDIUM_WAIT).until(
+                lambda driver: not self.login_required() or
+                               driver.find_elements_by_xpath("//div[@data-test-subj='loginErrorMessage']"))
+        except TimeoutException:
+            pass
+        if not self.login_required():
+            return
+
         login_error_message = self.get_login_error_message()
         
         if login_error_message is not None:
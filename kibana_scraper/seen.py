@@ -0,0 +1,52 @@
+"""
+kibana_scraper/seen.py
+
+Index of the User IDs already scraped into the segments of a section
+
+The IDs are kept in a set, for the deduplication of the documents. It is
+built from the sorted User IDs, which the store keeps for each segment, so
+the CSV files are not read, unless they were added or changed since.
+"""
+import threading
+
+from .store import SegmentStore
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The targets and shards of a section share one index, possibly from several workers
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+class SeenIndex:
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.ids = set()
+        with store.lock:
+            for name in store.segments:
+                self.ids.update(store.get_ids(name).tolist())
+        logger.info("%s: %d seen IDs", store.section, len(self.ids))
+
+    @staticmethod
+    def get(section):
+        """Returns the index of a section, shared by all its targets"""
+        with _indices_lock:
+            if section not in _indices:
+                _indices[section] = SeenIndex(SegmentStore.get(section))
+            return _indices[section]
+
+    def __contains__(self, user_id):
+        return user_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, user_id):
+        with self.lock:
+            self.ids.add(user_id)
+
+    def update(self, user_ids):
+        with self.lock:
+            self.ids.update(user_ids)
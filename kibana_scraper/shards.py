@@ -0,0 +1,211 @@
+"""
+kibana_scraper/shards.py
+
+Splits the time window of a target into shards, which can be scraped in parallel
+
+A shard is processed as a target of its own, writing its own CSV file. When all
+the shards of a section are completed, their files are merged into one.
+"""
+import re
+import csv
+import threading
+from datetime import datetime, timedelta, timezone
+
+from .checkpoints import Checkpoint
+from .store import SegmentStore
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_FROM_TIME_UTC = "'2016-12-29T09:57:28.503Z'"
+DEFAULT_TO_TIME_UTC = "now"
+
+DURATION_UNITS = {
+    "s": "seconds",
+    "m": "minutes",
+    "h": "hours",
+    "d": "days",
+    "w": "weeks",
+}
+
+
+def parse_duration(value):
+    """Parses durations like 90m, 12h or 30d"""
+    match = re.fullmatch(r"\s*(\d+)\s*([smhdw])\s*", value)
+    if match is None:
+        raise ValueError("Invalid duration: " + value)
+    return timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def parse_utc(value, now):
+    """Converts a from_time_utc / to_time_utc option value into a datetime"""
+    value = value.strip().strip("'")
+    if value == "now":
+        return now
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+
+
+def format_utc(moment):
+    """Converts a datetime into the format of the from_time_utc / to_time_utc options"""
+    return "'" + moment.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z'"
+
+
+class Shard:
+    """A part of the time window of a section"""
+
+    def __init__(self, section, config, from_time, to_time, group=None):
+        self.section = section
+        self.config = config
+        self.from_time = from_time
+        self.to_time = to_time
+        self.group = group
+
+    @property
+    def from_time_utc(self):
+        return format_utc(self.from_time)
+
+    @property
+    def to_time_utc(self):
+        return format_utc(self.to_time)
+
+    @property
+    def name(self):
+        return self.from_time.strftime("%Y%m%dT%H%M%S") + "-" + self.to_time.strftime("%Y%m%dT%H%M%S")
+
+    def __repr__(self):
+        return f"Shard({self.section}, {self.from_time_utc}, {self.to_time_utc})"
+
+
+class ShardGroup:
+    """Keeps track of the shards of a section, so the last one to complete can merge the results"""
+
+    def __init__(self, section, names, remaining):
+        self.section = section
+        self.names = names
+        self.remaining = remaining
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def complete(self, success):
+        """Registers a processed shard. Returns True, if all the shards have been completed successfully"""
+        with self.lock:
+            self.failed = self.failed or not success
+            self.remaining -= 1
+            return self.remaining == 0 and not self.failed
+
+    def merge(self, output_name):
+        """Merges the CSV files of all the shards, including the ones written by previous runs"""
+        prefixes = tuple(f"{self.section}-{name}-" for name in self.names)
+        names = SegmentStore.get(self.section).rewrite(lambda filename: filename.startswith(prefixes),
+                                                       output_name, merge)
+        logger.info("Merged %d shard files into %s", len(names), output_name)
+        Checkpoint.get(self.section).clear()
+
+
+def get_window(config, now=None):
+    now = now or datetime.now(timezone.utc)
+    from_time = parse_utc(config.get("from_time_utc", DEFAULT_FROM_TIME_UTC), now)
+    to_time = parse_utc(config.get("to_time_utc", DEFAULT_TO_TIME_UTC), now)
+    return from_time, to_time
+
+
+def fixed_windows(from_time, to_time, duration):
+    """Splits the window into parts of the given duration, the newest first"""
+    windows = []
+    end = to_time
+    while end > from_time:
+        start = max(from_time, end - duration)
+        windows.append((start, end))
+        end = start
+    return windows
+
+
+def adaptive_windows(from_time, to_time, count_hits, max_hits, min_duration):
+    """Halves the window until every part has at most max_hits hits, the newest first.
+
+    Parts without any hits are dropped."""
+    hits = count_hits(from_time, to_time)
+    if hits == 0:
+        return []
+    if hits <= max_hits or to_time - from_time <= min_duration:
+        return [(from_time, to_time)]
+
+    middle = from_time + (to_time - from_time) / 2
+    return (adaptive_windows(middle, to_time, count_hits, max_hits, min_duration) +
+            adaptive_windows(from_time, middle, count_hits, max_hits, min_duration))
+
+
+def plan(section, config, robot=None):
+    """Returns the shard group of a section and its shards still to be processed,
+    or None, if the section is not sharded.
+
+    The plan is kept in the checkpoint of the section, so an interrupted run is
+    resumed with the same shards. The adaptive mode counts the hits of the
+    candidate windows with the given robot."""
+    mode = config.get("shards", None)
+    if mode is None or mode == "none":
+        return None
+
+    checkpoint = Checkpoint.get(section)
+    windows = checkpoint.get_plan()
+
+    if windows is None:
+        from_time, to_time = get_window(config)
+
+        if mode == "fixed":
+            duration = parse_duration(config.get("shard_duration", "30d"))
+            windows = fixed_windows(from_time, to_time, duration)
+        elif mode == "adaptive":
+            max_hits = config.getint("shard_max_hits", 5000)
+            min_duration = parse_duration(config.get("shard_min_duration", "1h"))
+
+            def count_hits(start, end):
+                return robot.count_hits(Shard(section, config, start, end))
+
+            windows = adaptive_windows(from_time, to_time, count_hits, max_hits, min_duration)
+        else:
+            raise ValueError(f"Unknown shards mode '{mode}' in section {section}")
+
+        windows = [(format_utc(start), format_utc(end)) for start, end in windows]
+        checkpoint.set_plan(windows)
+
+    shards = [Shard(section, config, parse_utc(start, None), parse_utc(end, None)) for start, end in windows]
+    pending = [shard for shard in shards if not checkpoint.is_shard_completed(shard.name)]
+
+    group = ShardGroup(section, [shard.name for shard in shards], len(pending))
+    for shard in pending:
+        shard.group = group
+
+    logger.info("Section %s is split into %d shards, %d to be processed", section, len(shards), len(pending))
+
+    return group, pending
+
+
+def read_header(path):
+    with open(path, "r", newline="") as f:
+        return next(csv.reader(f), None)
+
+
+def merge(paths, output_path):
+    """Merges the CSV files of the shards into one, dropping the duplicated records
+
+    The columns are matched by name, the output has the columns of all the files, in the order they first appear."""
+    fieldnames = []
+    for path in paths:
+        # None for a shard without new records
+        header = read_header(path) or []
+        fieldnames.extend(name for name in header if name not in fieldnames)
+
+    seen = set()
+    with open(output_path, "w", newline="") as output:
+        if len(fieldnames) == 0:
+            return
+        writer = csv.DictWriter(output, fieldnames, restval="")
+        writer.writeheader()
+        for path in paths:
+            with open(path, "r", newline="") as f:
+                for row in csv.DictReader(f):
+                    if row["User ID"] in seen:
+                        continue
+                    seen.add(row["User ID"])
+                    writer.writerow(row)
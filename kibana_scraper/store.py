@@ -0,0 +1,431 @@
+"""
+kibana_scraper/store.py
+
+Storage of the records of a section, as segments
+
+Every CSV file in cache/<section>/csv is a segment of the section. The
+manifest in cache/<section>/store/manifest.json keeps the size, the row count
+and the Timestamp range of each segment, and the sorted User IDs of each
+segment are kept in cache/<section>/store/ids, so opening the store only
+reads the segments added or changed since (e.g. by the reprocess command).
+
+The records are appended to a new segment by a SegmentWriter, which makes
+them durable (flushed and synced to the disk) every store_sync_rows records,
+and before the checkpoint of a page is saved. With store_compaction, the
+small segments are merged into sorted segments of up to store_compact_rows
+records by a background thread, keeping the newest record of a User ID, so
+the number of segments (and the time to open the store) stays flat as the
+runs accumulate. The merged segments are removed only after the new one was
+synced, and found to hold all their User IDs.
+
+The Timestamps are written in one format (UTC, milliseconds, as the api
+engine requests them), so the copies of a record stored by several runs sort
+next to each other. A segment with Timestamps of another format is not
+sorted, and is normalized when it is sorted.
+"""
+import os
+import re
+import csv
+import json
+import threading
+from datetime import datetime
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+from .config import config
+from .signals import signals
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The targets and shards of a section share one store, possibly from several workers
+_stores = {}
+_stores_lock = threading.Lock()
+
+# The manifests of the earlier versions are read again, as their sorted flags ignore the Timestamp format
+MANIFEST_VERSION = 2
+
+TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z$")
+
+
+def normalize_timestamp(value):
+    """Returns a Timestamp in the format of TIMESTAMP_PATTERN, blank if missing, or as it is if it can't be parsed"""
+    if value is None or value != value:
+        return ""
+    text = str(value).strip()
+    if text == "" or TIMESTAMP_PATTERN.match(text):
+        return text
+    try:
+        # The format of the Discover page: Nov 28, 2019 @ 12:08:25.997
+        moment = pd.Timestamp(text.replace(" @ ", " "))
+    except ValueError:
+        return text
+    if moment is pd.NaT:
+        return ""
+    moment = moment.tz_localize("UTC") if moment.tzinfo is None else moment.tz_convert("UTC")
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.") + f"{moment.microsecond // 1000:03}Z"
+
+
+def timestamp_key(timestamp):
+    """Sort key of the Timestamps, the records without one go last"""
+    return timestamp == "", timestamp
+
+
+def sort_timestamps(timestamps):
+    """Returns the order of the Timestamps of a column, the blank ones last, stable"""
+    return np.lexsort((timestamps.to_numpy(dtype=str), (timestamps == "").to_numpy()))
+
+
+class Segment(namedtuple("Segment", ["size", "rows", "first", "last", "sorted"])):
+    """A CSV file of the store, with its size, record count and Timestamp range"""
+
+
+def scan_segment(path):
+    """Returns the Segment of a CSV file, and its User IDs, sorted"""
+    size = os.path.getsize(path)
+    try:
+        columns = pd.read_csv(path, usecols=lambda name: name in ("User ID", "Timestamp"), dtype=str,
+                              keep_default_na=False)
+    except pd.errors.EmptyDataError:
+        # File is empty
+        return Segment(size, 0, None, None, True), np.array([], dtype=str)
+
+    ids = np.sort(columns["User ID"].to_numpy(dtype=str))
+    if "Timestamp" not in columns or len(columns) == 0:
+        return Segment(size, len(columns), None, None, True), ids
+    timestamps = columns["Timestamp"]
+    blank = (timestamps == "").to_numpy()
+    present = timestamps[~blank]
+    # Sorted, if the blank Timestamps are all after the others, and the others are normalized
+    is_sorted = (bool(present.is_monotonic_increasing) and not blank[:len(present)].any()
+                 and bool(present.str.match(TIMESTAMP_PATTERN).all()))
+    if len(present) == 0:
+        return Segment(size, len(columns), None, None, is_sorted), ids
+    return Segment(size, len(columns), present.min(), present.max(), is_sorted), ids
+
+
+def compact_files(paths, output_path):
+    """Merges small segments into one, sorted by Timestamp, keeping the newest record of a User ID
+
+    The segments are read from the oldest to the newest written, as the names of the compacted and of the merged
+    shard segments do not sort by age."""
+    tables = []
+    for path in sorted(paths, key=os.path.getmtime):
+        try:
+            tables.append(pd.read_csv(path, dtype=str, keep_default_na=False))
+        except pd.errors.EmptyDataError:
+            # File is empty
+            pass
+
+    if len(tables) == 0:
+        open(output_path, "w").close()
+        return
+    table = pd.concat(tables, ignore_index=True)
+    table.drop_duplicates("User ID", keep="last", inplace=True)
+    if "Timestamp" in table:
+        table["Timestamp"] = table["Timestamp"].map(normalize_timestamp)
+        table = table.iloc[sort_timestamps(table["Timestamp"])]
+    table.to_csv(output_path, index=False)
+
+
+class SegmentWriter:
+    """Appends records to a new segment, synced to the disk every sync_rows records"""
+
+    def __init__(self, store, path, sync_rows):
+        self.store = store
+        self.path = path
+        self.sync_rows = sync_rows
+        self.output = open(path, "w", newline="")
+        self.writer = csv.writer(self.output)
+        self.lock = threading.Lock()
+        self.fieldnames = None
+        self.user_ids = []
+        self.first = None
+        self.last = None
+        self.sorted = True
+        self.blank = False
+        self.unsynced = 0
+
+    def write_header(self, fieldnames):
+        with self.lock:
+            self.fieldnames = list(fieldnames)
+            self.writer.writerow(self.fieldnames)
+
+    def writerows(self, rows):
+        """Writes rows of values in the order of the header"""
+        user_id_index = self.fieldnames.index("User ID")
+        timestamp_index = self.fieldnames.index("Timestamp") if "Timestamp" in self.fieldnames else None
+        with self.lock:
+            for row in rows:
+                # The missing values of the batches are NaN, the ones of the records None
+                row = ["" if value is None or value != value else value for value in row]
+                if timestamp_index is not None:
+                    row[timestamp_index] = normalize_timestamp(row[timestamp_index])
+                self.writer.writerow(row)
+                self.user_ids.append(str(row[user_id_index]))
+                if timestamp_index is not None:
+                    self.add_timestamp(str(row[timestamp_index]))
+                self.unsynced += 1
+
+            if self.unsynced >= self.sync_rows > 0:
+                self.sync_unlocked()
+
+    def add_timestamp(self, timestamp):
+        """Keeps the Timestamp range, and whether the records are in the order of timestamp_key"""
+        if timestamp == "":
+            self.blank = True
+            return
+        if self.blank or (self.last is not None and timestamp < self.last):
+            self.sorted = False
+        self.first = timestamp if self.first is None else min(self.first, timestamp)
+        self.last = timestamp if self.last is None else max(self.last, timestamp)
+
+    def sync(self):
+        """Makes the written records durable"""
+        with self.lock:
+            self.sync_unlocked()
+
+    def sync_unlocked(self):
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            self.sync_unlocked()
+            self.output.close()
+        self.store.add_segment(self)
+
+
+class SegmentStore:
+    def __init__(self, section, compact_rows=10000):
+        self.section = section
+        self.folder = os.path.join("cache", section, "csv")
+        self.store_folder = os.path.join("cache", section, "store")
+        self.ids_folder = os.path.join(self.store_folder, "ids")
+        self.manifest_path = os.path.join(self.store_folder, "manifest.json")
+        self.compact_rows = compact_rows
+        self.lock = threading.RLock()
+        self.segments = {}
+        self.open_segments = set()
+        self.compaction = None
+        os.makedirs(self.folder, exist_ok=True)
+        os.makedirs(self.ids_folder, exist_ok=True)
+        self.refresh()
+
+    @staticmethod
+    def get(section):
+        """Returns the store of a section, shared by all its targets"""
+        with _stores_lock:
+            if section not in _stores:
+                _stores[section] = SegmentStore(section, config["DEFAULT"].getint("store_compact_rows", 10000))
+            return _stores[section]
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, "rt") as f:
+                manifest = json.load(f)
+            if manifest.get("version", None) != MANIFEST_VERSION:
+                logger.info("Reading the segments of %s again, for the new manifest", self.section)
+                return {}
+            return {name: Segment(*segment) for name, segment in manifest["segments"].items()}
+        except FileNotFoundError:
+            return {}
+        except (ValueError, TypeError):
+            logger.warning("Ignoring corrupt store manifest: %s", self.manifest_path)
+            return {}
+
+    def save_manifest(self):
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "wt") as f:
+            json.dump({"version": MANIFEST_VERSION,
+                       "segments": {name: list(segment) for name, segment in self.segments.items()}}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.manifest_path)
+
+    def get_ids_path(self, name):
+        return os.path.join(self.ids_folder, name + ".npy")
+
+    def save_ids(self, name, ids):
+        temp_path = self.get_ids_path(name) + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, ids)
+        os.replace(temp_path, self.get_ids_path(name))
+
+    def refresh(self):
+        """Brings the manifest up to date with the CSV files, reading only the new or changed ones"""
+        with self.lock:
+            manifest = self.load_manifest()
+            names = [name for name in sorted(os.listdir(self.folder))
+                     if name not in self.open_segments and os.path.isfile(os.path.join(self.folder, name))]
+
+            self.segments = {}
+            read = 0
+            for name in names:
+                segment = manifest.get(name, None)
+                path = os.path.join(self.folder, name)
+                if (segment is None or segment.size != os.path.getsize(path)
+                        or not os.path.exists(self.get_ids_path(name))):
+                    segment, ids = scan_segment(path)
+                    self.save_ids(name, ids)
+                    read += 1
+                self.segments[name] = segment
+
+            # The files merged or replaced since
+            for name in set(manifest) - set(self.segments):
+                self.remove_ids(name)
+            self.save_manifest()
+
+        logger.info("%s: %d segments, %d records, %d segments read", self.section, len(self.segments),
+                    sum(segment.rows for segment in self.segments.values()), read)
+
+    def remove_ids(self, name):
+        try:
+            os.remove(self.get_ids_path(name))
+        except FileNotFoundError:
+            pass
+
+    def get_ids(self, name):
+        """Returns the sorted User IDs of a segment"""
+        return np.load(self.get_ids_path(name), mmap_mode="r")
+
+    def open_segment(self, name):
+        """Returns a SegmentWriter for a new segment, added to the store when it is closed"""
+        with self.lock:
+            self.open_segments.add(name)
+        return SegmentWriter(self, os.path.join(self.folder, name),
+                             config["DEFAULT"].getint("store_sync_rows", 500))
+
+    def add_segment(self, writer):
+        name = os.path.basename(writer.path)
+        ids = np.sort(np.array(writer.user_ids, dtype=str))
+        segment = Segment(os.path.getsize(writer.path), len(writer.user_ids), writer.first, writer.last, writer.sorted)
+        with self.lock:
+            self.save_ids(name, ids)
+            self.segments[name] = segment
+            self.open_segments.discard(name)
+            self.save_manifest()
+
+    def rewrite(self, select, output_name, write):
+        """Replaces the selected segments by the one written by write(paths, output_path)
+
+        The new segment is written next to the manifest, synced and checked to hold all the User IDs of the old
+        ones, and moved in place before the old ones are removed."""
+        with self.lock:
+            names = [name for name in sorted(self.segments) if select(name)]
+            paths = [os.path.join(self.folder, name) for name in names]
+            temp_path = os.path.join(self.store_folder, output_name + ".tmp")
+            write(paths, temp_path)
+            with open(temp_path, "rb+") as f:
+                os.fsync(f.fileno())
+
+            segment, ids = scan_segment(temp_path)
+            expected = np.unique(np.concatenate([self.get_ids(name) for name in names] + [np.array([], dtype=str)]))
+            if not np.array_equal(np.unique(ids), expected):
+                os.remove(temp_path)
+                raise RuntimeError(f"{output_name} does not hold the records of {', '.join(names)}, kept them")
+
+            output_path = os.path.join(self.folder, output_name)
+            os.replace(temp_path, output_path)
+            self.save_ids(output_name, ids)
+            self.segments[output_name] = segment
+            for name, path in zip(names, paths):
+                if name == output_name:
+                    # Rewritten in place
+                    continue
+                os.remove(path)
+                self.segments.pop(name)
+                self.remove_ids(name)
+            self.save_manifest()
+            return names
+
+    def sort_segment(self, name):
+        """Rewrites a segment sorted by Timestamp, without the duplicated records, returns its new Segment"""
+        with self.lock:
+            if name not in self.segments:
+                return None
+            self.rewrite(lambda selected: selected == name, name, compact_files)
+            return self.segments[name]
+
+    def compact(self):
+        """Merges the small segments, up to compact_rows records each"""
+        with self.lock:
+            small = [(name, segment.rows) for name, segment in sorted(self.segments.items())
+                     if segment.rows < self.compact_rows]
+
+        groups = []
+        group, rows = [], 0
+        for name, segment_rows in small:
+            if rows + segment_rows > self.compact_rows and len(group) > 0:
+                groups.append(group)
+                group, rows = [], 0
+            group.append(name)
+            rows += segment_rows
+        groups.append(group)
+
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        for i, group in enumerate(groups):
+            if len(group) < 2 or signals.stop:
+                continue
+            output_name = f"{self.section}-compacted-{stamp}-{i}.csv"
+            group = set(group)
+            names = self.rewrite(lambda name: name in group, output_name, compact_files)
+            logger.info("%s: compacted %d segments into %s", self.section, len(names), output_name)
+
+    def start_compaction(self):
+        """Compacts the store in a background thread, once per run"""
+        if not config["DEFAULT"].getboolean("store_compaction", False):
+            return
+        with self.lock:
+            if self.compaction is None:
+                self.compaction = threading.Thread(target=self.run_compaction, name=f"compaction-{self.section}",
+                                                   daemon=True)
+                self.compaction.start()
+
+    def run_compaction(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error("Compaction of %s failed: %s", self.section, e, exc_info=True)
+
+    def lookup(self, user_id):
+        """Returns the record of a User ID as a dict, or None"""
+        with self.lock:
+            names = sorted(self.segments, reverse=True)
+        for name in names:
+            ids = self.get_ids(name)
+            position = np.searchsorted(ids, user_id)
+            if position < len(ids) and ids[position] == user_id:
+                with open(os.path.join(self.folder, name), "r", newline="") as f:
+                    for row in csv.DictReader(f):
+                        if row["User ID"] == user_id:
+                            return row
+        return None
+
+    def scan(self, start=None, end=None):
+        """Yields the records of the segments overlapping [start, end] Timestamp range, as DataFrames"""
+        with self.lock:
+            segments = sorted(self.segments.items())
+        for name, segment in segments:
+            if segment.rows == 0:
+                continue
+            if segment.first is not None and ((end is not None and segment.first > end) or
+                                              (start is not None and segment.last < start)):
+                continue
+            table = pd.read_csv(os.path.join(self.folder, name), dtype={"User ID": str, "Timestamp": str})
+            if start is not None:
+                table = table[table["Timestamp"] >= start]
+            if end is not None:
+                table = table[table["Timestamp"] <= end]
+            yield table
+
+
+def shutdown():
+    """Waits for the compactions started by this run"""
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        if store.compaction is not None:
+            store.compaction.join()
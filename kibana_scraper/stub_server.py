@@ -0,0 +1,261 @@
+"""
+kibana_scraper/stub_server.py
+
+A local stand-in for the Kibana endpoints used by the ApiRobot, so the API
+engine can be run offline.
+
+It serves the documents found in a folder of JSON files, or in the archive of
+the json cache of a previous run, or synthetic documents, through the index pattern and the console
+proxy endpoints.
+
+Usage:
+    python -m kibana_scraper.stub_server --documents cache/signals/json --pattern bc1eb410-d58b-11e9-88b0-39c2e841f443=signals
+
+Then point a target url at http://localhost:5601/app/kibana#/discover?...
+"""
+import os
+import re
+import json
+import random
+import fnmatch
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from optparse import OptionParser
+from urllib.parse import urlparse, parse_qs, unquote
+
+from .archive import JsonArchive
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def to_epoch_millis(value, now=None):
+    """Converts an ISO-8601 string, 'now' or epoch millis into epoch millis"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if value == "now":
+        now = now or datetime.now(timezone.utc)
+        return int(now.timestamp() * 1000)
+    value = value.replace("Z", "+00:00")
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def format_epoch_millis(millis):
+    moment = datetime.fromtimestamp(millis / 1000, timezone.utc)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def generate_documents(count, index="signals", time_field="createdOn", samples=1000):
+    """Creates synthetic signals-layout documents with a sine-like PPG channel"""
+    documents = []
+    start = datetime(2019, 9, 1, tzinfo=timezone.utc)
+    for i in range(count):
+        created_on = start + timedelta(seconds=random.randint(0, 90 * 24 * 3600), milliseconds=random.randint(0, 999))
+        time = [j / 100 for j in range(samples)]
+        amplitude = [round(500 + 100 * ((j % 80) / 80 - 0.5) ** 2 + random.random(), 3) for j in range(samples)]
+        documents.append({
+            "_index": index,
+            "_type": "_doc",
+            "_id": f"stub-{i:08d}",
+            "_source": {
+                "accountId": f"account-{i % 97}",
+                time_field: format_epoch_millis(int(created_on.timestamp() * 1000)),
+                "status": "Completed",
+                "profile": {"age": 20 + i % 60, "sex": random.choice(["Male", "Female"]),
+                            "height": 170, "weight": 70, "diabetesDiagnosis": i % 3 == 0,
+                            "smokingStatus": "NonSmoker"},
+                "source": {"model": "Stub", "make": "Stub"},
+                "channels": [{"time": time, "amplitude": amplitude}],
+            },
+        })
+    return documents
+
+
+def load_documents(folder):
+    documents = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(".json"):
+            with open(os.path.join(folder, filename), "rt") as f:
+                documents.append(json.load(f))
+
+    if os.path.exists(os.path.join(folder, "index.sqlite")):
+        # The json cache of a section, archived, possibly by a running scraper
+        archive = JsonArchive(folder, readonly=True)
+        documents.extend(json.loads(text) for user_id, text in archive)
+        archive.close()
+    return documents
+
+
+class Index:
+    """Answers search requests over an in-memory list of documents"""
+
+    def __init__(self, documents, patterns=None):
+        self.documents = documents
+        self.patterns = patterns or {}
+        self.positions = {id(d): i for i, d in enumerate(documents)}
+
+    def get_index_pattern(self, pattern_id):
+        title = self.patterns.get(pattern_id, pattern_id)
+        return {"id": pattern_id, "type": "index-pattern", "attributes": {"title": title}}
+
+    def get_time(self, document, time_field):
+        value = document.get("_source", {}).get(time_field)
+        if value is None:
+            value = document.get("fields", {}).get(time_field, [None])[0]
+        return None if value is None else to_epoch_millis(value)
+
+    def get_tiebreaker(self, document, field):
+        """The value of the tiebreaker field of the sort, _shard_doc is the position of the document"""
+        if field == "_shard_doc":
+            return self.positions[id(document)]
+        value = document.get("_source", {}).get(field)
+        if value is None:
+            value = document.get("fields", {}).get(field, [""])[0]
+        return "" if value is None else str(value)
+
+    def open_pit(self, index):
+        return {"id": "pit:" + index}
+
+    def search(self, index, body):
+        if "pit" in body:
+            index = body["pit"]["id"][len("pit:"):]
+        documents = [d for d in self.documents if fnmatch.fnmatch(d.get("_index", ""), index)]
+
+        sort = body.get("sort", [])
+        time_field, order, tiebreaker = None, "desc", "_shard_doc"
+        if len(sort) > 0:
+            time_field = list(sort[0].keys())[0]
+            order = sort[0][time_field].get("order", "desc")
+        if len(sort) > 1:
+            tiebreaker = list(sort[1].keys())[0]
+        if tiebreaker == "_id":
+            raise ValueError("Fielddata access on the _id field is disallowed")
+        if tiebreaker == "_shard_doc" and "pit" not in body:
+            raise ValueError("[_shard_doc] sort field cannot be used without [point in time]")
+
+        for query_filter in body.get("query", {}).get("bool", {}).get("filter", []):
+            for field, bounds in query_filter.get("range", {}).items():
+                gte = to_epoch_millis(bounds["gte"]) if "gte" in bounds else None
+                lte = to_epoch_millis(bounds["lte"]) if "lte" in bounds else None
+                documents = [d for d in documents if self.get_time(d, field) is not None
+                             and (gte is None or self.get_time(d, field) >= gte)
+                             and (lte is None or self.get_time(d, field) <= lte)]
+
+        total = len(documents)
+
+        hits = []
+        if time_field is not None:
+            sign = -1 if order == "desc" else 1
+            documents.sort(key=lambda d: (sign * self.get_time(d, time_field), self.get_tiebreaker(d, tiebreaker)))
+            for document in documents:
+                hit = dict(document)
+                hit["sort"] = [self.get_time(document, time_field), self.get_tiebreaker(document, tiebreaker)]
+                hit["fields"] = {time_field: [format_epoch_millis(hit["sort"][0])]}
+                hits.append(hit)
+
+            search_after = body.get("search_after")
+            if search_after is not None:
+                after = (sign * search_after[0], search_after[1])
+                hits = [h for h in hits if (sign * h["sort"][0], h["sort"][1]) > after]
+        else:
+            hits = [dict(d) for d in documents]
+
+        size = body.get("size", 10)
+        response = {
+            "took": 0,
+            "timed_out": False,
+            "hits": {"total": {"value": total, "relation": "eq"}, "hits": hits[:size]},
+        }
+        if "pit" in body:
+            response["pit_id"] = body["pit"]["id"]
+        return response
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    index = None
+
+    def send_json(self, data, status=200):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = re.fullmatch(r"/api/saved_objects/index-pattern/([^/]+)", url.path)
+        if match:
+            self.send_json(self.index.get_index_pattern(unquote(match.group(1))))
+        else:
+            self.send_json({"statusCode": 404, "error": "Not Found"}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        if url.path == "/api/console/proxy":
+            parameters = parse_qs(url.query)
+            path = parameters.get("path", [""])[0].split("?")[0]
+            method = parameters.get("method", ["POST"])[0]
+            match = re.fullmatch(r"/?(?:([^/]+)/)?_search", path)
+            if match:
+                try:
+                    self.send_json(self.index.search(match.group(1) or "*", body))
+                except ValueError as e:
+                    self.send_json({"error": {"type": "illegal_argument_exception", "reason": str(e)}, "status": 400},
+                                   400)
+                return
+            match = re.fullmatch(r"/?([^/]+)/_pit", path)
+            if match:
+                self.send_json(self.index.open_pit(match.group(1)))
+                return
+            if re.fullmatch(r"/?_pit", path) and method == "DELETE":
+                self.send_json({"succeeded": True, "num_freed": 1})
+                return
+
+        self.send_json({"statusCode": 404, "error": "Not Found"}, 404)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(index, host="localhost", port=5601):
+    handler = type("Handler", (StubRequestHandler,), {"index": index})
+    server = ThreadingHTTPServer((host, port), handler)
+    logger.info("Serving %d documents at http://%s:%d", len(index.documents), host, port)
+    return server
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = OptionParser()
+    parser.add_option("--host", dest="host", default="localhost")
+    parser.add_option("--port", dest="port", type="int", default=5601)
+    parser.add_option("--documents", dest="documents", default=None,
+                      help="Folder of JSON documents to serve")
+    parser.add_option("--generate", dest="generate", type="int", default=0,
+                      help="Number of synthetic signals documents to serve")
+    parser.add_option("--pattern", dest="patterns", action="append", default=[],
+                      help="Index pattern mapping in the form <id>=<index>")
+
+    (options, args) = parser.parse_args()
+
+    documents = []
+    if options.documents is not None:
+        documents += load_documents(options.documents)
+    if options.generate > 0:
+        documents += generate_documents(options.generate)
+
+    patterns = dict(pattern.split("=", 1) for pattern in options.patterns)
+
+    server = serve(Index(documents, patterns), options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
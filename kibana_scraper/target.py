@@ -1,9 +1,15 @@
 import os
-import csv
 import pathlib
-import pandas as pd
 from datetime import datetime
 from .records import RecordFactory
+from .shards import DEFAULT_FROM_TIME_UTC, DEFAULT_TO_TIME_UTC
+from .checkpoints import Checkpoint
+from .seen import SeenIndex
+from .store import SegmentStore
+from .archive import JsonArchive
+from . import decoding
+from .config import config as package_config
+from .pipeline import Pipeline, process_batch
 
 import logging
 logger = logging.getLogger(__name__)
@@ -14,44 +20,78 @@ class Target:
         pathlib.Path(self.json_cache).mkdir(parents=True, exist_ok=True)
         pathlib.Path(self.csv_cache).mkdir(parents=True, exist_ok=True)
 
-    def initialize_record_cache(self):
-        logger.info("Loading previous results from cache")
-        lists = []
-        for filename in os.listdir(self.csv_cache):
-            file_path = os.path.join(self.csv_cache, filename)
-            if os.path.isfile(file_path):
-                try:
-                    records = pd.read_csv(file_path)
-                    lists.append(records)
-                except pd.errors.EmptyDataError:
-                    # File is empty
-                    pass
-                
-        if len(lists) == 0:
-            return None
-        else:
-            return pd.concat(lists)
-
-    def __init__(self, section, config, model = None):
+    def __init__(self, section, config, model = None, shard = None):
         self.section = section
         self.config = config
         self.model = model
+        self.shard = shard
         self.json_cache = os.path.join("cache", self.section, "json")
         self.csv_cache = os.path.join("cache", self.section, "csv")
+        self.archive = None
+
+        self.checkpoint = Checkpoint.get(section)
+
+        if shard is None:
+            self.from_time_utc = config.get("from_time_utc", DEFAULT_FROM_TIME_UTC)
+            self.to_time_utc = config.get("to_time_utc", DEFAULT_TO_TIME_UTC)
+            self.shard_name = None
+            output_name = self.section
+        else:
+            self.from_time_utc = shard.from_time_utc
+            self.to_time_utc = shard.to_time_utc
+            self.shard_name = shard.name
+            output_name = self.section + "-" + shard.name
 
         self.initialize_working_folders()
-        self.record_cache = self.initialize_record_cache()
-        self.new_records = set()
-        self.output_path = os.path.join(self.csv_cache, datetime.now().strftime(self.section + "-%Y%m%d-%H%M%S.csv"))
+        self.store = SegmentStore.get(section)
+        self.seen_ids = SeenIndex.get(section)
+        # Submitted to the pipeline, but not stored yet
+        self.pending_ids = set()
+        self.output_name = datetime.now().strftime(output_name + "-%Y%m%d-%H%M%S.csv")
+        self.output_path = os.path.join(self.csv_cache, self.output_name)
 
         self.fieldnames = None
 
     def __enter__(self):
-        self.output = open(self.output_path, "w", newline="")
+        self.output = self.store.open_segment(self.output_name)
+        self.store.start_compaction()
+
+        self.pipeline = None
+        workers = package_config["DEFAULT"].getint("pipeline_workers", 0)
+        if workers > 0 and self.model is not None:
+            self.pipeline = Pipeline(self, workers,
+                                     package_config["DEFAULT"].getint("pipeline_queue_size", 4 * workers),
+                                     package_config["DEFAULT"].getboolean("pipeline_ordered", True))
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.pipeline is not None:
+            logger.info("Waiting for the pipeline to drain")
+            self.pipeline.close()
         self.output.close()
+        if self.archive is not None:
+            self.archive.sync()
+
+    def get_cursor(self):
+        """Returns the pagination cursor saved by a previous run, or None"""
+        return self.checkpoint.get_cursor(self.shard_name)
+
+    def save_cursor(self, cursor):
+        """Saves the cursor of the next page, once the current page is fully processed"""
+        if self.pipeline is not None:
+            # The documents of the page must be written before the cursor moves past them
+            self.pipeline.flush()
+        self.output.sync()
+        if self.archive is not None:
+            self.archive.sync()
+        self.checkpoint.set_cursor(cursor, self.shard_name)
+
+    def complete(self):
+        """Marks the target as completed, so it is not resumed"""
+        if self.shard is None:
+            self.checkpoint.clear()
+        else:
+            self.checkpoint.complete_shard(self.shard_name)
 
     def parse(self, json):
         if self.model is None:
@@ -61,26 +101,72 @@ class Target:
             return record
 
     def seen(self, record_id):
-        return record_id in self.new_records or (
-                self.record_cache is not None and
-                self.record_cache[self.record_cache["User ID"] == record_id].shape[0] > 0
-        )
+        return record_id in self.seen_ids or record_id in self.pending_ids
+
+    def release(self, user_ids):
+        """Called by the pipeline, when the documents are stored, or failed"""
+        self.pending_ids.difference_update(user_ids)
 
     def store(self, data):
-        writer = csv.writer(self.output)
         if self.fieldnames is None:
             self.fieldnames = data.keys()
-            writer.writerow(self.fieldnames)
+            self.output.write_header(self.fieldnames)
+
+        self.output.writerows([[data[key] for key in self.fieldnames]])
+        self.seen_ids.add(data["User ID"])
+
+    def process(self, document, user_id):
+        """Parses and stores a document, in the pipeline if enabled"""
+        if self.pipeline is not None:
+            self.pending_ids.add(user_id)
+            self.pipeline.submit(document, user_id)
+        else:
+            self.store_document(self.parse(document), document, user_id)
+            logger.info("Stored: %s", user_id)
+
+    def process_batch(self, documents, user_ids):
+        """Parses and stores many documents (JSON texts, or decoded hits), batch_size at a time, in the pipeline if enabled"""
+        size = package_config["DEFAULT"].getint("batch_size", 100)
+        for start in range(0, len(documents), size):
+            chunk = documents[start:start + size]
+            chunk_ids = user_ids[start:start + size]
+            if self.pipeline is not None:
+                self.pending_ids.update(chunk_ids)
+                self.pipeline.submit_batch(chunk, chunk_ids)
+            else:
+                self.store_batch(*process_batch(self.model, chunk), chunk, chunk_ids)
+                for user_id in chunk_ids:
+                    logger.info("Stored: %s", user_id)
+
+    def store_batch(self, fieldnames, rows, documents, user_ids):
+        """Stores the rows of a RecordBatch, and the documents if save_json_files is enabled"""
+        if self.fieldnames is None:
+            self.fieldnames = list(fieldnames)
+            self.output.write_header(self.fieldnames)
+
+        if list(fieldnames) != list(self.fieldnames):
+            positions = [list(fieldnames).index(name) for name in self.fieldnames]
+            rows = [[row[i] for i in positions] for row in rows]
+        self.output.writerows(rows)
+        self.seen_ids.update(user_ids)
 
-        row = [data[key] for key in self.fieldnames]
-        writer.writerow(row)
+        if package_config["DEFAULT"].getboolean("save_json_files", False):
+            for document, user_id in zip(documents, user_ids):
+                self.store_json(document, user_id)
 
-        self.new_records.add(data["User ID"])
+    def store_document(self, data, document, user_id):
+        """Stores a record, and the document it was parsed from if save_json_files is enabled"""
+        self.store(data)
+        if package_config["DEFAULT"].getboolean("save_json_files", False):
+            self.store_json(document, user_id)
 
     def store_json(self, text, user_id):
-        file_path = os.path.join(self.json_cache, user_id + ".json")
-        with open(file_path, "wt", newline="") as f:
-            f.write(text)
+        if not isinstance(text, str):
+            # A hit decoded by the api engine
+            text = decoding.dumps(text)
+        if self.archive is None:
+            self.archive = JsonArchive.get(self.section)
+        self.archive.append(user_id, text)
 
 
         
\ No newline at end of file
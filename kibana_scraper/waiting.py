@@ -0,0 +1,163 @@
+"""
+kibana_scraper/waiting.py
+
+Event driven waiting for the robot
+
+Instead of sleeping and polling the page from Python, the conditions are
+awaited inside the browser with MutationObservers, so the calls return as soon
+as the page changes.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+# Kibana shows the global loading indicator while any request is in flight
+IS_LOADING_FUNCTION = """
+var isLoading = function () {
+    return document.querySelector("[data-test-subj='globalLoadingIndicator']") !== null;
+};
+"""
+
+# Resolves true as soon as the number of rows in the tbody differs from the given
+# count, or false, when all the hits of the doc-table are rendered and nothing is
+# loading, or the timeout expires
+NEW_ROWS_SCRIPT = IS_LOADING_FUNCTION + """
+var tbody = arguments[0];
+var rowCount = arguments[1];
+var timeout = arguments[2];
+var done = arguments[arguments.length - 1];
+
+var changed = function () {
+    return tbody.children.length !== rowCount;
+};
+
+var allRendered = function () {
+    try {
+        // The doc-table renders the fetched hits in chunks, two rows for each hit
+        var scope = window.angular && window.angular.element(tbody).scope();
+        return !!scope && Array.isArray(scope.hits) && tbody.children.length >= scope.hits.length * 2;
+    } catch (e) {
+        return false;
+    }
+};
+
+if (changed()) {
+    return done(true);
+}
+if (allRendered() && !isLoading()) {
+    return done(false);
+}
+
+var timer = null;
+var observer = new MutationObserver(function () {
+    if (changed()) {
+        observer.disconnect();
+        clearTimeout(timer);
+        done(true);
+    }
+});
+observer.observe(tbody, {childList: true});
+
+timer = setTimeout(function () {
+    observer.disconnect();
+    done(changed());
+}, timeout * 1000);
+"""
+
+# Resolves true on the first animation frame after the loading indicator
+# disappears, or false, when the timeout expires
+IDLE_SCRIPT = IS_LOADING_FUNCTION + """
+var timeout = arguments[0];
+var done = arguments[arguments.length - 1];
+
+var finish = function (result) {
+    window.requestAnimationFrame(function () {
+        done(result);
+    });
+};
+
+if (!isLoading()) {
+    return finish(true);
+}
+
+var timer = null;
+var observer = new MutationObserver(function () {
+    if (!isLoading()) {
+        observer.disconnect();
+        clearTimeout(timer);
+        finish(true);
+    }
+});
+observer.observe(document.body, {childList: true, subtree: true, attributes: true, attributeFilter: ["data-test-subj"]});
+
+timer = setTimeout(function () {
+    observer.disconnect();
+    finish(false);
+}, timeout * 1000);
+"""
+
+
+# Replaces the hash state of the Discover app, and resolves true as soon as the
+# doc-table received a new set of hits (or the no results message is shown) and
+# nothing is loading, or false, when the timeout expires
+HASH_NAVIGATION_SCRIPT = IS_LOADING_FUNCTION + """
+var hash = arguments[0];
+var timeout = arguments[1];
+var done = arguments[arguments.length - 1];
+
+var getHits = function () {
+    var docTable = document.querySelector("doc-table");
+    if (!docTable || !window.angular) {
+        return undefined;
+    }
+    var element = window.angular.element(docTable);
+    var scope = element.isolateScope() || element.scope();
+    return scope ? scope.hits : undefined;
+};
+
+var noResults = function () {
+    return document.querySelector("discover-no-results") !== null;
+};
+
+var before = getHits();
+if (before === undefined) {
+    return done(false);
+}
+
+window.location.hash = hash;
+
+var started = Date.now();
+var timer = setInterval(function () {
+    var hits = getHits();
+    if (((hits !== undefined && hits !== before) || noResults()) && !isLoading()) {
+        clearInterval(timer);
+        window.requestAnimationFrame(function () {
+            done(true);
+        });
+    } else if (Date.now() - started > timeout * 1000) {
+        clearInterval(timer);
+        done(false);
+    }
+}, 100);
+"""
+
+
+class Waiter:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def execute(self, script, timeout, *args):
+        # The script timeout has to outlast the timeout handled by the script itself
+        self.driver.set_script_timeout(timeout + 5)
+        return self.driver.execute_async_script(script, *args)
+
+    def wait_for_new_rows(self, tbody, row_count, timeout):
+        """Returns True, as soon as the number of rows in tbody changes, False if no more rows will be loaded"""
+        return self.execute(NEW_ROWS_SCRIPT, timeout, tbody, row_count, timeout)
+
+    def navigate_hash(self, hash, timeout):
+        """Changes the hash of the page, returns True, as soon as the app displays the new results"""
+        return self.execute(HASH_NAVIGATION_SCRIPT, timeout, hash, timeout)
+
+    def wait_for_idle(self, timeout):
+        """Returns True, as soon as no request is loading and the page is rendered, False on timeout"""
+        return self.execute(IDLE_SCRIPT, timeout, timeout)